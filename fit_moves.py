@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+import merged
+import referee
+from merged import MOVE_FEATURES, BattleState, DistanceFields, Session, Vector
+
+# exploration: every self-play game draws its weights from these ranges
+WEIGHT_RANGES = {'ring': (0.0, 2.0), 'crowd': (0.0, 2.0), 'danger': (0.0, 4.0), 'exposure': (0.0, 0.5),
+                 'speed': (0.0, 4.0)}
+RIDGE = 1e-3
+
+
+def to_json(o) -> dict:
+    return json.loads(json.dumps(o, default=lambda x: x.to_json()))
+
+
+def planned_positions(state: dict, output: dict) -> dict:
+    ships = {s['Id']: s for s in state['My']}
+    positions = {}
+    for command in output['UserCommands']:
+        parameters = command['Parameters']
+        ship = ships.get(parameters['Id'])
+        if ship is None:
+            continue
+        position = Vector.from_json(ship['Position'])
+        if command['Command'] == 'MOVE':
+            positions[ship['Id']] = Vector.from_json(parameters['Target'])
+        elif command['Command'] == 'ACCELERATE':
+            positions[ship['Id']] = position + Vector.from_json(ship['Velocity']) + \
+                                    Vector.from_json(parameters['Vector'])
+    return positions
+
+
+# features of the positions the bot chose, computed the way score_moves saw them
+def chosen_features(state: dict, positions: dict) -> dict:
+    battle_state = BattleState.from_json(state)
+    target = next((o for o in battle_state.Opponent if o == merged.session.target), None)
+    if target is None or not positions:
+        return {}
+    others = [o for o in battle_state.Opponent if o != target]
+    ring, crowd = merged.session.params['ring'], merged.session.params['crowd']
+    grid = merged.bit_grid() if merged.DISTANCE_FIELDS else None
+    fields = DistanceFields(grid, battle_state, target, others, ring) if grid is not None else None
+    ids = list(positions)
+    origins = {ship.Id: ship.Position for ship in battle_state.My}
+    columns = merged.move_features([positions[i] for i in ids], target.Position, [o.Position for o in others],
+                                   [f.Target for f in battle_state.FireInfos], ring, crowd, fields,
+                                   [origins[i] for i in ids])
+    return {i: row for i, row in zip(ids, zip(*columns))}
+
+
+# One in-process game of merged against itself, each side with its own weights and parameters.
+# Every sample is the features of a ship's chosen move and its cost over that turn: the damage it
+# took minus its share of the damage dealt.
+def self_play(seed: int, weights: tuple = (None, None), map_size: int = referee.MAP_SIZE, record: bool = True,
+              params: tuple = (None, None)) -> dict:
+    rng = random.Random(seed)
+    sessions, choices = [], []
+    for w, p in zip(weights, params):
+        player = len(sessions)
+        merged.session = Session(p)
+        merged.session.move_weights = w
+        choices.append(to_json(merged.make_draft(referee.draft_options(player, map_size))))
+        sessions.append(merged.session)
+    battle = referee.Battle([referee.place_ships(i, c, map_size, rng) for i, c in enumerate(choices)], map_size)
+
+    samples = []
+    while not battle.finished():
+        states = [battle.state_for(i) for i in range(2)]
+        outputs, features = [], []
+        for player, s in enumerate(sessions):
+            merged.session = s
+            outputs.append(to_json(merged.make_turn(states[player])))
+            if record:
+                features.append(chosen_features(states[player], planned_positions(states[player], outputs[-1])))
+
+        health = {s.Id: s.Health for fleet in battle.fleets for s in fleet}
+        battle.apply(outputs)
+        if not record:
+            continue
+        after = {s.Id: s.Health for fleet in battle.fleets for s in fleet}
+        for player in range(2):
+            own = [s['Id'] for s in states[player]['My']]
+            dealt = sum(health[s['Id']] - max(0, after.get(s['Id'], 0)) for s in states[player]['Opponent'])
+            for ship_id, row in features[player].items():
+                taken = health[ship_id] - max(0, after.get(ship_id, 0))
+                samples.append((row, taken - dealt / len(own)))
+
+    totals = [sum(s.Health for s in fleet) for fleet in battle.fleets]
+    return {'seed': seed, 'winner': battle.winner(), 'health': totals, 'samples': samples}
+
+
+def random_weights(rng: random.Random) -> tuple:
+    return tuple(rng.uniform(*WEIGHT_RANGES[name]) for name in MOVE_FEATURES)
+
+
+def explore(seed: int) -> list:
+    rng = random.Random(seed)
+    return self_play(seed, (random_weights(rng), random_weights(rng)))['samples']
+
+
+# ridge regression by the normal equations, features plus an intercept
+def fit(samples: list) -> Tuple[list, float]:
+    rows = [(1.0,) + tuple(map(float, row)) for row, _ in samples]
+    n = len(rows[0])
+    a = [[sum(r[i] * r[j] for r in rows) + (RIDGE * len(rows) if i == j and i else 0.0) for j in range(n)]
+         for i in range(n)]
+    b = [sum(r[i] * y for r, (_, y) in zip(rows, samples)) for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot], b[col], b[pivot] = a[pivot], a[col], b[pivot], b[col]
+        for r in range(n):
+            if r != col and a[col][col]:
+                k = a[r][col] / a[col][col]
+                a[r] = [x - k * y for x, y in zip(a[r], a[col])]
+                b[r] -= k * b[col]
+    w = [b[i] / a[i][i] if a[i][i] else 0.0 for i in range(n)]
+    return w[1:], w[0]
+
+
+def duel(seed: int, weights: tuple) -> Optional[int]:
+    # the learned weights play the seat given by the seed parity against the hand-written keys
+    seat = seed % 2
+    pair = (weights, None) if seat == 0 else (None, weights)
+    result = self_play(seed, pair, record=False)
+    if result['winner'] is None:
+        return None
+    return int(result['winner'] == seat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit the move evaluation weights from self-play')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--evaluate', type=int, default=100, help='duels against the hand-written score')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='move_weights.json')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    samples = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for game in pool.map(explore, range(args.seed, args.seed + args.games)):
+            samples += game
+    weights, intercept = fit(samples)
+    print(f'{len(samples)} samples from {args.games} games in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+    print(', '.join(f'{name}: {w:.4f}' for name, w in zip(MOVE_FEATURES, weights)), file=sys.stderr)
+
+    if args.evaluate:
+        seeds = range(args.seed + args.games, args.seed + args.games + args.evaluate)
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(duel, seeds, [tuple(weights)] * len(seeds)))
+        wins, draws = sum(r == 1 for r in results), results.count(None)
+        print(f'learned vs hand-written: {wins} wins, {draws} draws, {len(results) - wins - draws} losses',
+              file=sys.stderr)
+
+    with open(args.out, 'w') as out:
+        json.dump({'features': list(MOVE_FEATURES), 'weights': weights, 'intercept': intercept,
+                   'samples': len(samples)}, out, indent=2)
+    print(f'Weights saved to {args.out}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import time
+import random
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import merged
+import referee
+from fit_moves import to_json
+from merged import BattleState, OpeningBook, Session
+
+
+# The first turns of one game with the lookahead search at a budget no live turn could afford.
+# Sides in formation record their moves until the first shot, the other side is placed by the
+# referee's draw.
+def play_opening(map_size: int, seed: int, formations: tuple, turns: int, search_ms: float) -> list:
+    merged.SEARCH_MS = search_ms
+    rng = random.Random(seed)
+    sessions, choices = [], []
+    for player, in_formation in enumerate(formations):
+        merged.session = Session()
+        merged.session.book = OpeningBook() if in_formation else None
+        choices.append(to_json(merged.make_draft(referee.draft_options(player, map_size))))
+        sessions.append(merged.session)
+    battle = referee.Battle([referee.place_ships(i, c, map_size, rng) for i, c in enumerate(choices)], map_size)
+
+    recorded = OpeningBook()
+    entries = []
+    while battle.turn < turns and not battle.finished() and not battle.fire_infos:
+        outputs = []
+        for player, (s, in_formation) in enumerate(zip(sessions, formations)):
+            merged.session = s
+            state = battle.state_for(player)
+            output = merged.make_turn(state)
+            if in_formation:
+                battle_state = BattleState.from_json(state)
+                key = OpeningBook.key(battle_state)
+                recorded.put(key, battle_state.My[0].Position, output.UserCommands)
+                entries.append((key, recorded.entries.pop(key)))
+            outputs.append(to_json(output))
+        battle.apply(outputs)
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan the opening turns offline into an opening book')
+    parser.add_argument('--map-sizes', type=int, nargs='+', default=[referee.MAP_SIZE])
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--games', type=int, default=20, help='games per side against a drawn placement')
+    parser.add_argument('--search-ms', type=float, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='opening_book.json.gz')
+    args = parser.parse_args()
+
+    # both sides in formation is one game per map, a drawn opponent placement needs many
+    jobs = []
+    for map_size in args.map_sizes:
+        jobs.append((map_size, args.seed, (True, True)))
+        for i in range(args.games):
+            jobs.append((map_size, args.seed + i, (True, False) if i % 2 == 0 else (False, True)))
+
+    # the opponents differ between the games, a formation position keeps its most played moves
+    start = time.perf_counter()
+    votes = defaultdict(Counter)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(play_opening, m, s, f, args.turns, args.search_ms) for m, s, f in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            for key, entry in future.result():
+                votes[key][tuple(entry)] += 1
+            print(f'{done}/{len(jobs)} games, {len(votes)} positions', file=sys.stderr)
+    book = OpeningBook.load(args.out) or OpeningBook()
+    for key, counter in votes.items():
+        book.entries[key] = list(counter.most_common(1)[0][0])
+    book.save(args.out)
+    print(f'{len(book.entries)} positions saved to {args.out} in {time.perf_counter() - start:.1f} s',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,114 @@
+import gc
+import gzip
+import heapq
+import importlib
 import json
+import multiprocessing
+import os
+import random
+import selectors
+import signal
+import socket
+import sqlite3
+import sys
+import threading
 import time
-from dataclasses import dataclass
+import tracemalloc
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from dataclasses import MISSING, dataclass, fields
 from enum import Enum
-from typing import List, Optional
-from itertools import product
-
-target = None
-map_size = 30
-ship_size = 2
+from typing import Iterable, Iterator, List, Optional, Tuple, Union, get_args, get_origin, get_type_hints
+from bisect import bisect_left, bisect_right
+from itertools import islice, product
+from math import isqrt
+from multiprocessing.connection import wait
+
+MAP_SIZE = 30
+SHIP_SIZE = 2
+
+# strategy constants tuned by sweep.py: the range kept to the target, the radius in which other
+# opponents count as crowding, the assumed ship size, the slack added to gun radii and the cost of
+# a unit of speed left after the move against a cell off the range
+PARAMS = {
+    'ring': 5,
+    'crowd': 6,
+    'ship_size': SHIP_SIZE,
+    'gun_slack': 0,
+    'momentum': 2,
+}
+
+# combine the move score terms as a (ring, crowding, danger) tuple instead of a sum
+SCORE_LEXICOGRAPHIC = os.environ.get('BOT_SCORE_LEXICOGRAPHIC') == '1'
+
+# number of remembered decisions; 0 turns the decision cache off
+DECISION_CACHE_SIZE = int(os.environ.get('BOT_DECISION_CACHE', 0))
+HEALTH_BUCKET = 10
+
+# weight of the newest turn in the per-opponent threat averages
+THREAT_DECAY = 0.2
+# opponents whose distances fall in the same band count as equally near, the threat ranks them
+TARGET_BAND = int(os.environ.get('BOT_TARGET_BAND', 4))
+
+# record decision events on every n-th turn (0 is off) and dump them on demand, on slow turns
+# (above BOT_TRACE_SLOW_MS) and at game end, to BOT_TRACE_FILE or stderr
+TRACE_EVERY = int(os.environ.get('BOT_TRACE', 0))
+TRACE_CAPACITY = 4096
+TRACE_SLOW_MS = float(os.environ.get('BOT_TRACE_SLOW_MS', 'inf'))
+TRACE_FILE = os.environ.get('BOT_TRACE_FILE')
+TRACE_TOP_K = 3
+
+# keep the raw input of the n slowest turns (0 is off) and write them as fixtures at game end
+# and on SIGUSR1, with their timing
+CAPTURE_SLOWEST = int(os.environ.get('BOT_CAPTURE_SLOWEST', 0))
+CAPTURE_DIR = os.environ.get('BOT_CAPTURE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests'))
+
+# sample the stack of make_turn every BOT_PROFILE_US microseconds (0 is off), keep the
+# turns slower than BOT_PROFILE_SLOW_MS and write them as collapsed stacks at game end and on SIGUSR1
+PROFILE_US = int(os.environ.get('BOT_PROFILE_US', 0))
+PROFILE_SLOW_MS = float(os.environ.get('BOT_PROFILE_SLOW_MS', 0))
+PROFILE_DIR = os.environ.get('BOT_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stacks'))
+
+# opening book written by make_book.py
+BOOK_FILE = os.environ.get('BOT_BOOK', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opening_book.json.gz'))
+
+# per-opponent profiles kept across matches, for the opponent named by BOT_OPPONENT
+PROFILES_FILE = os.environ.get('BOT_PROFILES',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles.sqlite3'))
+OPPONENT = os.environ.get('BOT_OPPONENT')
+
+# planner modules played next to merged in worker processes, comma separated, and the milliseconds
+# of a turn they get
+ENSEMBLE = [name for name in os.environ.get('BOT_ENSEMBLE', '').split(',') if name]
+ENSEMBLE_MS = float(os.environ.get('BOT_ENSEMBLE_MS', 50))
+
+# reuse turn objects across turns and run the garbage collector only between turns
+POOLING = os.environ.get('BOT_POOLING') == '1'
+# score moves with the whole-map distance fields (ring around the danger, exposure to the enemies);
+# their cost grows with the map volume, about a millisecond per turn on the 30 map
+DISTANCE_FIELDS = os.environ.get('BOT_DISTANCE_FIELDS') == '1'
+# trace every allocation with tracemalloc and report the bytes a turn allocates at its peak; this
+# slows the turns down several times, it is for measuring, not for playing
+TRACE_ALLOCS = os.environ.get('BOT_TRACE_ALLOCS') == '1'
+
+# fitted move evaluation weights, see load_move_weights
+MOVE_WEIGHTS_FILE = os.environ.get('BOT_MOVE_WEIGHTS',
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'move_weights.json'))
+
+# milliseconds of a turn given to the lookahead search (0 is off) and its deepest iteration
+SEARCH_MS = float(os.environ.get('BOT_SEARCH_MS', 0))
+SEARCH_DEPTH = 6
+TRANSPOSITION_SIZE = 1 << 16
+
+# fleets of at most this many ships on both sides are played by the endgame search, which gets
+# this many milliseconds of the turn (0 is off)
+ENDGAME_SHIPS = 2
+ENDGAME_MS = float(os.environ.get('BOT_ENDGAME_MS', 0))
+# accelerations per ship the endgame plays, the best by the greedy score
+ENDGAME_WIDTH = int(os.environ.get('BOT_ENDGAME_WIDTH', 3))
+# nodes per second assumed before the first endgame search has measured it
+ENDGAME_RATE = 10000
 
 
 class JSONCapability:
@@ -52,7 +153,139 @@ class Vector:
         return (self.X, self.Y, self.Z) == (other.X, other.Y, other.Z)
 
     def in_bounds(self) -> bool:
-        return all(all(0 < c + d < map_size for d in range(3)) for c in (self.X, self.Y, self.Z))
+        return 0 <= self.X and 0 <= self.Y and 0 <= self.Z and \
+            max(self.X, self.Y, self.Z) + session.ship_size < session.map_size
+
+
+# endregion
+
+# region cells
+
+# maps up to this volume use a flat byte grid, bigger ones a hash set of packed cells
+DENSE_VOLUME_LIMIT = 1 << 18
+
+
+class Cells:
+    def __init__(self, size: int):
+        self.size = size
+
+    def key(self, v: Vector) -> Optional[int]:
+        size = self.size
+        if 0 <= v.X < size and 0 <= v.Y < size and 0 <= v.Z < size:
+            return v.X + size * (v.Y + size * v.Z)
+        return None
+
+    def update(self, vectors):
+        for v in vectors:
+            self.add(v)
+
+
+class DenseCells(Cells):
+    def __init__(self, size: int):
+        super().__init__(size)
+        self.grid = bytearray(size ** 3)
+        self.touched = []
+
+    def add(self, v: Vector):
+        i = self.key(v)
+        if i is not None and not self.grid[i]:
+            self.grid[i] = 1
+            self.touched.append(i)
+
+    def __contains__(self, v: Vector) -> bool:
+        i = self.key(v)
+        return i is not None and self.grid[i] == 1
+
+    def __len__(self) -> int:
+        return len(self.touched)
+
+    def clear(self):
+        # only the cells set this turn are reset, so clearing does not depend on the map volume
+        grid = self.grid
+        for i in self.touched:
+            grid[i] = 0
+        self.touched.clear()
+
+
+class SparseCells(Cells):
+    def __init__(self, size: int):
+        super().__init__(size)
+        self.keys = set()
+
+    def add(self, v: Vector):
+        i = self.key(v)
+        if i is not None:
+            self.keys.add(i)
+
+    def __contains__(self, v: Vector) -> bool:
+        return self.key(v) in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def clear(self):
+        self.keys.clear()
+
+
+def make_cells() -> Cells:
+    size = session.map_size
+    return DenseCells(size) if size ** 3 <= DENSE_VOLUME_LIMIT else SparseCells(size)
+
+
+# Fire footprints as axis-aligned boxes sorted by their low X instead of enumerated cells, so
+# memory is O(shots) whatever the ship size. A point can only be in the boxes whose low X lies
+# within the widest extent below it, one bisect range, and only those are tested on Y and Z.
+class Boxes:
+    def __init__(self):
+        self.boxes = []
+        self.lows = []
+        self.extent = 0
+        self.dirty = False
+
+    def add(self, low: Vector, extent: int):
+        self.boxes.append((low.X, low.Y, low.Z, low.X + extent, low.Y + extent, low.Z + extent))
+        self.extent = max(self.extent, extent)
+        self.dirty = True
+
+    def seal(self):
+        self.boxes.sort()
+        self.lows = [box[0] for box in self.boxes]
+        self.dirty = False
+
+    def __contains__(self, v: Vector) -> bool:
+        if self.dirty:
+            self.seal()
+        x, y, z = v.X, v.Y, v.Z
+        for lx, ly, lz, hx, hy, hz in islice(self.boxes, bisect_left(self.lows, x - self.extent),
+                                             bisect_right(self.lows, x)):
+            if x <= hx and ly <= y <= hy and lz <= z <= hz:
+                return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def clear(self):
+        self.boxes.clear()
+        self.lows.clear()
+        self.extent = 0
+        self.dirty = False
+
+    # the covered cells as a bit set of the grid
+    def mask(self, grid: 'BitGrid') -> int:
+        bits = 0
+        for lx, ly, lz, hx, _, _ in self.boxes:
+            bits |= grid.box(Vector(lx, ly, lz), hx - lx)
+        return bits
+
+
+def fire_boxes(battle_state: 'BattleState', boxes: Optional[Boxes] = None) -> Boxes:
+    boxes = Boxes() if boxes is None else boxes
+    size = session.ship_size
+    corner = Vector(size, size, size)
+    for fire in battle_state.FireInfos:
+        boxes.add(fire.Target - corner, size)
+    return boxes
 
 
 # endregion
@@ -117,14 +350,7 @@ class EquipmentBlock(JSONCapability):
 
     @classmethod
     def from_json(cls, data):
-        if EquipmentType(data['Type']) == EquipmentType.Energy:
-            return EnergyBlock(**data)
-        if EquipmentType(data['Type']) == EquipmentType.Gun:
-            return GunBlock(**data)
-        if EquipmentType(data['Type']) == EquipmentType.Engine:
-            return EngineBlock(**data)
-        if EquipmentType(data['Type']) == EquipmentType.Health:
-            return HealthBlock(**data)
+        return decode_equipment(data)
 
 
 @dataclass
@@ -178,11 +404,7 @@ class Ship(JSONCapability):
 
     @classmethod
     def from_json(cls, data):
-        if data.get('Equipment'):
-            data['Equipment'] = list(map(EquipmentBlock.from_json, data.get('Equipment', [])))
-        data['Position'] = Vector.from_json(data['Position'])
-        data['Velocity'] = Vector.from_json(data['Velocity'])
-        return cls(**data)
+        return decoders[cls](data, *parse_vectors([data['Position'], data['Velocity']]))
 
     def __eq__(self, other: 'Ship') -> bool:
         return self.Id == other.Id
@@ -199,9 +421,7 @@ class FireInfo(JSONCapability):
 
     @classmethod
     def from_json(cls, data):
-        data['Source'] = Vector.from_json(data['Source'])
-        data['Target'] = Vector.from_json(data['Target'])
-        return cls(**data)
+        return decoders[cls](data, *parse_vectors([data['Source'], data['Target']]))
 
 
 @dataclass
@@ -212,10 +432,499 @@ class BattleState(JSONCapability):
 
     @classmethod
     def from_json(cls, data):
-        my = list(map(Ship.from_json, data['My']))
-        opponent = list(map(Ship.from_json, data['Opponent']))
-        fire_infos = list(map(FireInfo.from_json, data['FireInfos']))
-        return cls(fire_infos, my, opponent)
+        return decode_battle_state(data)
+
+
+# endregion
+
+# region pooling
+
+def set_vectors(vectors: List[Vector], coords: List[int]):
+    for i, vector in enumerate(vectors):
+        vector.X, vector.Y, vector.Z = coords[3 * i:3 * i + 3]
+
+
+class TurnPool:
+    def __init__(self):
+        self.ships = {}
+        self.fire_infos = []
+        self.commands = {}
+        self.battle_state = BattleState([], [], [])
+        self.battle_output = BattleOutput(UserCommands=[])
+        self.pos_black_list = Boxes()
+        self.moves = None
+
+    def ship(self, data: dict) -> Ship:
+        ship = self.ships.get(data['Id'])
+        if ship is None:
+            # equipment never changes during the battle, so it is decoded only once
+            ship = self.ships[data['Id']] = Ship.from_json(data)
+        else:
+            ship.Energy = data.get('Energy')
+            ship.Health = data.get('Health')
+        return ship
+
+    def battle_state_from_json(self, data: dict) -> BattleState:
+        state = self.battle_state
+        state.My[:] = map(self.ship, data['My'])
+        state.Opponent[:] = map(self.ship, data['Opponent'])
+
+        fires = data['FireInfos']
+        while len(self.fire_infos) < len(fires):
+            self.fire_infos.append(FireInfo(0, Vector(0, 0, 0), Vector(0, 0, 0)))
+        state.FireInfos[:] = islice(self.fire_infos, len(fires))
+        for fire, raw in zip(state.FireInfos, fires):
+            fire.EffectType = raw['EffectType']
+
+        ships = state.My + state.Opponent
+        set_vectors(
+            [v for ship in ships for v in (ship.Position, ship.Velocity)] +
+            [v for fire in state.FireInfos for v in (fire.Source, fire.Target)],
+            parse_coords(
+                [s[k] for s in data['My'] + data['Opponent'] for k in SHIP_VECTORS] +
+                [f[k] for f in fires for k in FIRE_VECTORS]
+            )
+        )
+        return state
+
+    def new_turn(self) -> BattleOutput:
+        self.battle_output.Message = None
+        self.battle_output.UserCommands.clear()
+        if self.moves is None or self.moves.size != session.map_size:
+            self.moves = make_cells()
+        self.pos_black_list.clear()
+        self.moves.clear()
+        return self.battle_output
+
+    def command(self, name: str, parameters_type: type, ship_id: int, *args) -> UserCommand:
+        key = (name, ship_id) + args[:-1]
+        command = self.commands.get(key)
+        if command is None:
+            command = self.commands[key] = UserCommand(name, parameters_type(ship_id, *args))
+        else:
+            setattr(command.Parameters, fields(parameters_type)[-1].name, args[-1])
+        return command
+
+
+def move_command(ship_id: int, target_pos: Vector) -> UserCommand:
+    if session.pool is not None:
+        return session.pool.command('MOVE', MoveCommandParameters, ship_id, target_pos)
+    return UserCommand(Command='MOVE', Parameters=MoveCommandParameters(ship_id, target_pos))
+
+
+def attack_command(ship_id: int, name: str, aim: Vector) -> UserCommand:
+    if session.pool is not None:
+        return session.pool.command('ATTACK', AttackCommandParameters, ship_id, name, aim)
+    return UserCommand(Command='ATTACK', Parameters=AttackCommandParameters(ship_id, name, aim))
+
+
+def accelerate_command(ship_id: int, vector: Vector) -> UserCommand:
+    if session.pool is not None:
+        return session.pool.command('ACCELERATE', AccelerateCommandParameters, ship_id, vector)
+    return UserCommand(Command='ACCELERATE', Parameters=AccelerateCommandParameters(ship_id, vector))
+
+
+# endregion
+
+# region reachability
+
+# Every turn a ship changes its velocity by at most max_accelerate per axis and then moves by it.
+# Axes are independent under the Chebyshev metric, so the table is one-dimensional.
+class ReachTable:
+    def __init__(self, max_accelerate: int, size: int):
+        a = max(1, max_accelerate)
+        self.max_accelerate = a
+        self.max_speed = isqrt(2 * a * size) + a
+
+        # displacement covered while braking at full thrust from a given velocity
+        self.brake = {}
+        for v in range(-self.max_speed, self.max_speed + 1):
+            distance, speed = 0, v
+            while speed:
+                speed = speed - a if speed > 0 else speed + a
+                speed = 0 if speed * v < 0 else speed
+                distance += speed
+            self.brake[v] = distance
+
+    def can_stop(self, position: Vector, velocity: Vector) -> bool:
+        brake = self.brake
+        if max(abs(velocity.X), abs(velocity.Y), abs(velocity.Z)) > self.max_speed:
+            return False
+        return Vector(position.X + brake[velocity.X], position.Y + brake[velocity.Y],
+                      position.Z + brake[velocity.Z]).in_bounds()
+
+
+reach_tables = {}
+
+
+def reach_table(max_accelerate: int) -> ReachTable:
+    key = (max_accelerate, session.map_size)
+    if key not in reach_tables:
+        reach_tables[key] = ReachTable(max_accelerate, session.map_size)
+    return reach_tables[key]
+
+
+# a ship at rest keeps plain MOVE commands, a moving one gets the exact acceleration
+def movement_command(ship: Ship, target_pos: Vector) -> UserCommand:
+    velocity = ship.Velocity
+    if target_pos == ship.Position or not (velocity.X or velocity.Y or velocity.Z):
+        return move_command(ship.Id, target_pos)
+    return accelerate_command(ship.Id, target_pos - ship.Position - velocity)
+
+
+# endregion
+
+# region distance fields
+
+# The whole map as one bit set (bit x + size * (y + size * z)), so a Chebyshev dilation of any
+# set of cells is nine shifts and masks on a Python int instead of a loop over cells.
+class BitGrid:
+    def __init__(self, size: int):
+        n, n2 = size, size * size
+        self.size = size
+        self.full = (1 << n2 * n) - 1
+        rows = sum(1 << n * i for i in range(n2))
+        planes = sum(1 << n2 * i for i in range(n))
+        # cells that may move one step up or down along each axis without wrapping
+        self.masks = []
+        for shift, last in ((1, ((1 << n - 1) - 1) * rows),
+                            (n, ((1 << n * (n - 1)) - 1) * planes),
+                            (n2, (1 << n2 * (n - 1)) - 1)):
+            self.masks.append((shift, last, last << shift))
+        self.cubes = {}
+
+    def index(self, v: Vector) -> Optional[int]:
+        size = self.size
+        if 0 <= v.X < size and 0 <= v.Y < size and 0 <= v.Z < size:
+            return v.X + size * (v.Y + size * v.Z)
+        return None
+
+    def cells(self, vectors) -> int:
+        bits = 0
+        for v in vectors:
+            i = self.index(v)
+            if i is not None:
+                bits |= 1 << i
+        return bits
+
+    def box(self, low: Vector, extent: int) -> int:
+        if self.index(low) is None or self.index(low + Vector(extent, extent, extent)) is None:
+            return self.cells(low + Vector(*p) for p in product(range(extent + 1), repeat=3))
+        cube = self.cubes.get(extent)
+        if cube is None:
+            cube = self.cubes[extent] = self.cells(Vector(*p) for p in product(range(extent + 1), repeat=3))
+        return cube << self.index(low)
+
+    def dilate(self, bits: int, radius: int = 1) -> int:
+        for _ in range(radius):
+            for shift, up, down in self.masks:
+                bits |= ((bits & up) << shift) | ((bits & down) >> shift)
+        return bits
+
+    # Every cell moved by each of low..high along an axis (0 is X), stopping at the walls like a
+    # ship does: a shifted cell against the wall stays there.
+    def sweep(self, bits: int, axis: int, low: int, high: int) -> int:
+        shift, up, down = self.masks[axis]
+        base = low if low > 0 else high if high < 0 else 0
+        for _ in range(base):
+            bits = ((bits & up) << shift) | (bits & ~up)
+        for _ in range(-base):
+            bits = ((bits & down) >> shift) | (bits & ~down)
+        for _ in range(high - base):
+            bits |= (bits & up) << shift
+        for _ in range(base - low):
+            bits |= (bits & down) >> shift
+        return bits
+
+    # Turns to reach every cell from a ship at start moving with velocity. After k turns of
+    # acceleration bounded by step the velocity is within step * k of the start one, so level k is
+    # the previous one moved by every such velocity, without the blocked cells. A wall stops the
+    # ship and zeroes the velocity on its axis, once a level touches one the velocity on that axis
+    # may also be within step * k of zero. Keeping a path's velocity out of the state makes this a
+    # lower bound: the levels are exact on open space and never later than the ship elsewhere.
+    def reach(self, start: Vector, velocity: Vector, blocked: int = 0, step: int = 1,
+              limit: int = 8) -> 'DistanceField':
+        free = self.full & ~blocked
+        walls = [self.full & ~(up & down) for _, up, down in self.masks]
+        stopped = [False] * 3
+        # the ship is where it is, even in a blocked cell
+        current = self.cells([start])
+        levels = [current]
+        for k in range(1, limit + 1):
+            spread = min(step * k, self.size)
+            for axis, v in enumerate((velocity.X, velocity.Y, velocity.Z)):
+                stopped[axis] = stopped[axis] or bool(current & walls[axis])
+                low, high = (min(v, 0), max(v, 0)) if stopped[axis] else (v, v)
+                current = self.sweep(current, axis, low - spread, high + spread)
+            current &= free
+            if not current:
+                break
+            # the levels are cumulative, a cell passed at turn k is reached in k turns
+            levels.append(levels[-1] | current)
+        return DistanceField(self, levels)
+
+    def field(self, sources: int, blocked: int = 0, step: int = 1, limit: Optional[int] = None) -> 'DistanceField':
+        free = self.full & ~blocked
+        levels = [sources & free]
+        while limit is None or len(levels) <= limit:
+            following = self.dilate(levels[-1], step) & free
+            if following == levels[-1]:
+                break
+            levels.append(following)
+        return DistanceField(self, levels)
+
+
+class DistanceField:
+    def __init__(self, grid: BitGrid, levels: List[int]):
+        self.grid = grid
+        self.levels = levels
+        # bytes give O(1) bit tests, shifting a big int would copy it on every query
+        length = (grid.full.bit_length() + 7) // 8
+        self.tables = [level.to_bytes(length, 'little') for level in levels]
+
+    def shell(self, radius: int) -> int:
+        if not 0 < radius < len(self.levels):
+            return 0
+        return self.levels[radius] & ~self.levels[radius - 1]
+
+    def distance(self, v: Vector) -> Optional[int]:
+        i = self.grid.index(v)
+        tables = self.tables
+        if i is None or not tables or not tables[-1][i >> 3] >> (i & 7) & 1:
+            return None
+        low, high = 0, len(tables) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if tables[middle][i >> 3] >> (i & 7) & 1:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+bit_grids = {}
+
+
+def bit_grid(size: Optional[int] = None) -> Optional[BitGrid]:
+    # huge maps keep the sparse engine, their fields would scale with the volume
+    size = session.map_size if size is None else size
+    if size ** 3 > DENSE_VOLUME_LIMIT:
+        return None
+    if size not in bit_grids:
+        bit_grids[size] = BitGrid(size)
+    return bit_grids[size]
+
+
+class DistanceFields:
+    def __init__(self, grid: BitGrid, battle_state: BattleState, target: Ship, others: List[Ship], ring: int,
+                 boxes: Optional[Boxes] = None):
+        self.grid = grid
+        self.boxes = boxes if boxes is not None else fire_boxes(battle_state)
+        self.danger = self.boxes.mask(grid)
+        self.enemy = grid.field(grid.cells(o.Position for o in others))
+        self.target = grid.field(grid.cells([target.Position]), limit=ring)
+        # cells on the desired ring around the target, reached around the danger
+        self.ring = grid.field(self.target.shell(ring), self.danger)
+        self.reach = {}
+
+    # Turns for an own ship to get to v at its MaxAccelerate around the danger, built on first use.
+    # Ship positions stop ship_size short of the far walls, so the field has a grid of its own.
+    def turns_to_reach(self, ship: Ship, v: Vector, horizon: int = 8) -> Optional[int]:
+        field = self.reach.get(ship.Id)
+        if field is None:
+            grid = bit_grid(session.map_size - session.ship_size)
+            engine = next((e for e in ship.Equipment or [] if isinstance(e, EngineBlock)), None)
+            step = engine.MaxAccelerate if engine is not None else 0
+            field = self.reach[ship.Id] = grid.reach(ship.Position, ship.Velocity, self.boxes.mask(grid), step, horizon)
+        return field.distance(v)
+
+
+# endregion
+
+# region scoring
+
+class ScoreTable:
+    def __init__(self, candidates: List[List[Vector]], keys: list):
+        self.candidates = candidates
+        self.keys = keys
+        self.starts = [0]
+        for vs in candidates:
+            self.starts.append(self.starts[-1] + len(vs))
+
+    def scores(self, i: int) -> list:
+        return self.keys[self.starts[i]:self.starts[i + 1]]
+
+    def order(self, i: int) -> List[int]:
+        scores = self.scores(i)
+        return sorted(range(len(scores)), key=scores.__getitem__)
+
+    def ranking(self, i: int) -> List[Vector]:
+        return [self.candidates[i][j] for j in self.order(i)]
+
+    def top(self, i: int, k: int) -> list:
+        scores = self.scores(i)
+        return [(scores[j], str(self.candidates[i][j])) for j in self.order(i)[:k]]
+
+
+MOVE_FEATURES = ('ring', 'crowd', 'danger', 'exposure', 'speed')
+
+
+# Weights of the move features in the order of MOVE_FEATURES, fit by fit_moves.py. Without the
+# file the hand-written score keys are used.
+def load_move_weights(path: str) -> Optional[tuple]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as inp:
+        model = json.load(inp)
+    weights = dict(zip(model['features'], model['weights']))
+    return tuple(float(weights.get(name, 0.0)) for name in MOVE_FEATURES)
+
+
+# The candidates of all ships are stacked into coordinate columns and every term is
+# computed column-wise, one pass per target, enemy or shot instead of a lambda per candidate.
+# origins are the positions the candidates are moved to from, the velocity left after the move
+# is the difference: a ship on the ring that keeps its speed leaves the ring on the next turn.
+def move_features(flat: List[Vector], target: Vector, others: List[Vector], fires: List[Vector],
+                  ring: int = 5, crowd: int = 6, fields: Optional[DistanceFields] = None,
+                  origins: Optional[List[Vector]] = None) -> Tuple[list, ...]:
+    xs, ys, zs = [v.X for v in flat], [v.Y for v in flat], [v.Z for v in flat]
+
+    def distances(p: Vector) -> List[int]:
+        px, py, pz = p.X, p.Y, p.Z
+        return [max(abs(x - px), abs(y - py), abs(z - pz)) for x, y, z in zip(xs, ys, zs)]
+
+    ring_term = [abs(ring - d) for d in distances(target)]
+    exposure = [0] * len(flat)
+    if fields is not None:
+        # the way to the ring around the danger, a cell cut off from it is never preferred
+        ring_term = [r if d is None else d for r, d in zip(ring_term, map(fields.ring.distance, flat))]
+        exposure = [-(d or 0) for d in map(fields.enemy.distance, flat)]
+    crowd_term = [0] * len(flat)
+    for o in others:
+        crowd_term = [c + (d < crowd) for c, d in zip(crowd_term, distances(o))]
+    # a shot at f hits the ships placed from f - ship_size to f, the danger is measured from the
+    # middle of that box, in doubled coordinates to stay whole, so it is the same from every side
+    size = session.ship_size
+    danger_term = [0] * len(flat)
+    for f in fires:
+        fx, fy, fz = 2 * f.X - size, 2 * f.Y - size, 2 * f.Z - size
+        danger_term = [c + (max(abs(2 * x - fx), abs(2 * y - fy), abs(2 * z - fz)) <= 2 * size + 2)
+                       for c, x, y, z in zip(danger_term, xs, ys, zs)]
+    speed = [0] * len(flat) if origins is None else \
+        [max(abs(x - o.X), abs(y - o.Y), abs(z - o.Z)) for x, y, z, o in zip(xs, ys, zs, origins)]
+    return ring_term, crowd_term, danger_term, exposure, speed
+
+
+# origins holds the position of the ship of every candidate list, momentum weighs the speed left
+# against the ring distance in the hand-written keys
+def score_moves(candidates: List[List[Vector]], target: Vector, others: List[Vector], fires: List[Vector],
+                ring: int = 5, crowd: int = 6, lexicographic: bool = False,
+                fields: Optional[DistanceFields] = None, weights: Optional[tuple] = None,
+                origins: Optional[List[Vector]] = None, momentum: int = 0) -> ScoreTable:
+    flat = [v for vs in candidates for v in vs]
+    starts = None if origins is None else [o for o, vs in zip(origins, candidates) for _ in vs]
+    ring_term, crowd_term, danger_term, exposure, speed = move_features(flat, target, others, fires, ring, crowd,
+                                                                         fields, starts)
+
+    if weights is not None:
+        # one dot product per candidate, lower is better like the tuple keys
+        w_ring, w_crowd, w_danger, w_exposure, w_speed = weights
+        keys = [w_ring * r + w_crowd * c + w_danger * d + w_exposure * e + w_speed * v
+                for r, c, d, e, v in zip(ring_term, crowd_term, danger_term, exposure, speed)]
+    else:
+        ring_term = [r + momentum * v for r, v in zip(ring_term, speed)]
+        if lexicographic:
+            keys = list(zip(ring_term, crowd_term, danger_term, exposure))
+        else:
+            keys = list(zip(map(int.__add__, ring_term, crowd_term), danger_term, exposure))
+    return ScoreTable(candidates, keys)
+
+
+# endregion
+
+# region fire allocation
+
+def can_fire(energy: Optional[int], gun: GunBlock) -> bool:
+    return energy is None or energy >= (gun.EnergyPrice or 0)
+
+
+# the referee measures a shot from the nearest cell of the shooter's box
+def shot_range(position: Vector, target: Vector) -> int:
+    size = session.ship_size
+    return max(max(p - t, t - p - size, 0) for p, t in zip((position.X, position.Y, position.Z),
+                                                           (target.X, target.Y, target.Z)))
+
+
+# the middle of the box an opponent drifts to, a shot there still hits after it accelerates by up
+# to half the ship size either way
+def aim_at(opponent: Ship) -> Vector:
+    half = session.ship_size // 2
+    return opponent.Position + opponent.Velocity + Vector(half, half, half)
+
+
+# all guns of the fleet are assigned at once: kills first, then damage without overkill
+def allocate_fire(battle_state: BattleState, target: Ship) -> List[UserCommand]:
+    opponents = battle_state.Opponent
+    aims = [aim_at(o) for o in opponents]
+    health = [o.Health or 0 for o in opponents]
+    energy = {ship.Id: ship.Energy for ship in battle_state.My}
+
+    # guns x opponents range matrix, stored as the list of reachable opponents per gun
+    guns = []
+    for ship in battle_state.My:
+        for gun in filter(lambda e: isinstance(e, GunBlock), ship.Equipment or []):
+            reach = [j for j, aim in enumerate(aims)
+                     if shot_range(ship.Position, aim) <= gun.Radius + session.params['gun_slack']]
+            if reach:
+                guns.append((ship, gun, reach, gun.Damage if gun.Damage > 0 else 1))
+
+    assigned = {}
+
+    # kill phase: cheapest kills first, most constrained guns first, overkill trimmed
+    for j in sorted(range(len(opponents)), key=lambda j: (health[j], opponents[j] != target)):
+        if health[j] <= 0:
+            continue
+        spent = dict(energy)
+        chosen, total = [], 0
+        for g in sorted((g for g in range(len(guns)) if g not in assigned and j in guns[g][2]),
+                        key=lambda g: (len(guns[g][2]), -guns[g][3])):
+            ship, gun, _, damage = guns[g]
+            if not can_fire(spent[ship.Id], gun):
+                continue
+            if spent[ship.Id] is not None:
+                spent[ship.Id] -= gun.EnergyPrice or 0
+            chosen.append(g)
+            total += damage
+            if total >= health[j]:
+                break
+        if total < health[j]:
+            continue
+        for g in sorted(chosen, key=lambda g: guns[g][3]):
+            if total - guns[g][3] >= health[j]:
+                chosen.remove(g)
+                total -= guns[g][3]
+        for g in chosen:
+            ship, gun, _, _ = guns[g]
+            if energy[ship.Id] is not None:
+                energy[ship.Id] -= gun.EnergyPrice or 0
+            assigned[g] = j
+        health[j] -= total
+
+    # damage phase: remaining guns go where their damage is not wasted
+    for g in sorted(range(len(guns)), key=lambda g: len(guns[g][2])):
+        ship, gun, reach, damage = guns[g]
+        if g in assigned or not can_fire(energy[ship.Id], gun):
+            continue
+        alive = [j for j in reach if health[j] > 0]
+        if not alive:
+            continue
+        j = max(alive, key=lambda j: (min(damage, health[j]), opponents[j] == target, -health[j]))
+        if energy[ship.Id] is not None:
+            energy[ship.Id] -= gun.EnergyPrice or 0
+        assigned[g] = j
+        health[j] -= damage
+
+    return [attack_command(guns[g][0].Id, guns[g][1].Name, aims[j]) for g, j in sorted(assigned.items())]
 
 
 # endregion
@@ -240,8 +949,7 @@ class DraftEquipment:
 
     @classmethod
     def from_json(cls, data: dict):
-        data['Equipment'] = EquipmentBlock.from_json(data['Equipment'])
-        return cls(**data)
+        return decoders[cls](data)
 
 
 @dataclass
@@ -258,10 +966,7 @@ class DraftOptions:
 
     @classmethod
     def from_json(cls, data):
-        data['CompleteShips'] = [DraftCompleteShip(**ship) for ship in data['CompleteShips']]
-        data['StartArea'] = {k: Vector.from_json(v) for k, v in data['StartArea'].items()}
-        data['Equipment'] = [DraftEquipment.from_json(equip) for equip in data['Equipment']]
-        return cls(**data)
+        return decoders[cls](data)
 
 
 @dataclass
@@ -270,115 +975,1576 @@ class DraftShipChoice(JSONCapability):
     Position: Optional[Vector] = None
 
 
+# region decoders
+
+SHIP_VECTORS = ('Position', 'Velocity')
+FIRE_VECTORS = ('Source', 'Target')
+
+
+def parse_coords(data: List[str]) -> List[int]:
+    # all "X/Y/Z" strings of a turn are split and converted in one go
+    return list(map(int, '/'.join(data).split('/')))
+
+
+def parse_vectors(data: List[str]) -> List[Vector]:
+    coords = parse_coords(data)
+    return list(map(Vector, coords[0::3], coords[1::3], coords[2::3]))
+
+
+def list_of(convert):
+    return lambda data: [convert(item) for item in data]
+
+
+def optional(convert):
+    return lambda data: None if data is None else convert(data)
+
+
+def converter(hint):
+    if hint is Vector:
+        return Vector.from_json
+    if hint is EquipmentBlock:
+        return decode_equipment
+    origin, args = get_origin(hint), get_args(hint)
+    if origin is Union:
+        inner = converter(next(a for a in args if a is not type(None)))
+        return inner and optional(inner)
+    if origin is list:
+        inner = converter(args[0])
+        return inner and list_of(inner)
+    if origin is dict:
+        inner = converter(args[1])
+        return inner and (lambda data: {k: inner(v) for k, v in data.items()})
+    if hint in decoders:
+        return decoders[hint]
+    return None
+
+
+# builds a constructor for a dataclass that reads a raw json dict without mutating it;
+# fields listed in external are passed already decoded as extra arguments
+def compile_decoder(cls: type, external: tuple = ()):
+    env = {'_cls': cls, '_new': object.__new__}
+    items = []
+    for f in fields(cls):
+        if f.name in external:
+            items.append(f'{f.name!r}: {f.name}')
+            continue
+        value = f'data[{f.name!r}]' if f.default is MISSING else f'data.get({f.name!r}, _d_{f.name})'
+        env[f'_d_{f.name}'] = f.default
+        convert = converter(get_type_hints(cls)[f.name])
+        if convert is not None:
+            if f.default is not MISSING:
+                convert = optional(convert)
+            env[f'_c_{f.name}'] = convert
+            value = f'_c_{f.name}({value})'
+        items.append(f'{f.name!r}: {value}')
+
+    source = (f'def decode(data, {", ".join(external)}):\n' if external else 'def decode(data):\n') + (
+        '    obj = _new(_cls)\n'
+        f'    obj.__dict__ = {{{", ".join(items)}}}\n'
+        '    return obj\n'
+    )
+    exec(source, env)
+    return env['decode']
+
+
+decoders = {}
+equipment_decoders = {
+    t.value: compile_decoder(block)
+    for t, block in ((EquipmentType.Energy, EnergyBlock), (EquipmentType.Gun, GunBlock),
+                     (EquipmentType.Engine, EngineBlock), (EquipmentType.Health, HealthBlock))
+}
+
+
+def decode_equipment(data: dict) -> EquipmentBlock:
+    return equipment_decoders[data['Type']](data)
+
+
+for _cls in (DraftCompleteShip, DraftEquipment, DraftOptions):
+    decoders[_cls] = compile_decoder(_cls)
+decoders[Ship] = compile_decoder(Ship, SHIP_VECTORS)
+decoders[FireInfo] = compile_decoder(FireInfo, FIRE_VECTORS)
+
+def decode_battle_state(data: dict) -> BattleState:
+    return decode_battle_states([data])[0]
+
+
+# the vectors of all states are parsed in one bulk call
+def decode_battle_states(states: List[dict]) -> List[BattleState]:
+    raw = []
+    for data in states:
+        raw += [s[k] for s in data['My'] + data['Opponent'] for k in SHIP_VECTORS]
+        raw += [f[k] for f in data['FireInfos'] for k in FIRE_VECTORS]
+    vectors = iter(parse_vectors(raw))
+    decode_ship, decode_fire = decoders[Ship], decoders[FireInfo]
+    battle_states = []
+    for data in states:
+        my = list(map(decode_ship, data['My'], vectors, vectors))
+        opponent = list(map(decode_ship, data['Opponent'], vectors, vectors))
+        battle_states.append(BattleState(list(map(decode_fire, data['FireInfos'], vectors, vectors)), my, opponent))
+    return battle_states
+
+
+# endregion
+
+
+# region threat
+
+# Shots are attributed to the opponent that fired them by their Source, and every opponent
+# keeps exponentially decaying averages in fixed slots, so a turn costs O(opponents + shots).
+class ThreatTracker:
+    def __init__(self, capacity: int, prior: Optional[dict] = None):
+        prior = prior or {}
+        self.capacity = capacity
+        self.slots = {}
+        self.fire_rate = [prior.get('fire_rate', 0.0)] * capacity
+        self.radius = [prior.get('radius', 0.0)] * capacity
+        self.pressure = [prior.get('pressure', 0.0)] * capacity
+        # the longest shot seen, a lower bound of the opponents' gun reach
+        self.reach = prior.get('reach', 0)
+        self.start = None
+
+    def slot(self, ship_id: int) -> Optional[int]:
+        slot = self.slots.get(ship_id)
+        if slot is None and len(self.slots) < self.capacity:
+            slot = self.slots[ship_id] = len(self.slots)
+        return slot
+
+    def update(self, battle_state: BattleState):
+        if self.start is None:
+            self.start = (len(battle_state.Opponent), sum(o.Health or 0 for o in battle_state.Opponent))
+        keep = 1 - THREAT_DECAY
+        for i in range(self.capacity):
+            self.fire_rate[i] *= keep
+            self.pressure[i] *= keep
+
+        # a shot leaves from where its ship was before moving
+        shooters = [(o, o.Position - o.Velocity, True) for o in battle_state.Opponent] + \
+                   [(m, m.Position - m.Velocity, False) for m in battle_state.My]
+        for fire in battle_state.FireInfos:
+            if not shooters:
+                break
+            ship, _, is_opponent = min(shooters, key=lambda s: min(s[1].clen(fire.Source),
+                                                                   s[0].Position.clen(fire.Source)))
+            slot = self.slot(ship.Id) if is_opponent else None
+            if slot is None:
+                continue
+            self.fire_rate[slot] += THREAT_DECAY
+            distance = fire.Source.clen(fire.Target)
+            self.reach = max(self.reach, distance)
+            radius = self.radius[slot]
+            self.radius[slot] = keep * radius + THREAT_DECAY * distance if radius else distance
+            if any(m.Position.clen(fire.Target) <= session.ship_size + 1 for m in battle_state.My):
+                self.pressure[slot] += THREAT_DECAY
+
+    def threat(self, ship_id: int) -> float:
+        slot = self.slots.get(ship_id)
+        if slot is None:
+            # an opponent that has not fired yet looks like an untouched slot, its prior
+            slot = len(self.slots)
+            if slot >= self.capacity:
+                return 0.0
+        return self.fire_rate[slot] + self.pressure[slot]
+
+    # what this game taught about the opponent, for its profile
+    def summary(self) -> dict:
+        used = list(self.slots.values())
+        ships, health = self.start or (0, 0)
+        return {
+            'fire_rate': sum(self.fire_rate[i] for i in used) / len(used) if used else 0.0,
+            'radius': sum(self.radius[i] for i in used) / len(used) if used else 0.0,
+            'pressure': sum(self.pressure[i] for i in used) / len(used) if used else 0.0,
+            'reach': self.reach,
+            'ships': ships,
+            'health': health,
+        }
+
+
+# endregion
+
+# region profiles
+
+PROFILE_FIELDS = ('fire_rate', 'radius', 'pressure', 'reach', 'ships', 'health')
+
+
+# Per-opponent averages over all games against it in a local SQLite file. Reads happen once in
+# the draft, writes on a thread after the game, so no turn ever waits for the disk.
+class ProfileStore:
+    def __init__(self, path: str):
+        self.path = path
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute(f'CREATE TABLE IF NOT EXISTS profiles (opponent TEXT PRIMARY KEY, games INTEGER, '
+                   f'{", ".join(f"{name} REAL" for name in PROFILE_FIELDS)})')
+        return db
+
+    def load(self, opponent: str) -> Optional[dict]:
+        if not os.path.exists(self.path):
+            return None
+        with closing(self.connect()) as db:
+            row = db.execute(f'SELECT games, {", ".join(PROFILE_FIELDS)} FROM profiles WHERE opponent = ?',
+                             (opponent,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('games',) + PROFILE_FIELDS, row))
+
+    def save(self, opponent: str, sample: dict):
+        with closing(self.connect()) as db, db:
+            row = db.execute(f'SELECT games, {", ".join(PROFILE_FIELDS)} FROM profiles WHERE opponent = ?',
+                             (opponent,)).fetchone()
+            games, *means = row or (0,) + (0.0,) * len(PROFILE_FIELDS)
+            # running means, except the reach which is the longest shot ever seen
+            values = [max(m, sample[name]) if name == 'reach' else (m * games + sample[name]) / (games + 1)
+                      for name, m in zip(PROFILE_FIELDS, means)]
+            db.execute(f'INSERT OR REPLACE INTO profiles VALUES (?, ?, {", ".join("?" * len(PROFILE_FIELDS))})',
+                       (opponent, games + 1, *values))
+
+    def save_async(self, opponent: str, sample: dict) -> threading.Thread:
+        writer = threading.Thread(target=self.save, args=(opponent, sample))
+        writer.start()
+        return writer
+
+
+# endregion
+
+
+# region trace
+
+class DecisionTrace:
+    def __init__(self, capacity: int, every: int):
+        self.events = [None] * capacity
+        self.head = 0
+        self.every = every
+        self.turn = 0
+        self.active = False
+
+    def begin(self, turn: int):
+        self.turn = turn
+        self.active = self.every > 0 and turn % self.every == 0
+
+    def record(self, *event):
+        self.events[self.head % len(self.events)] = (self.turn,) + event
+        self.head += 1
+
+    def dump(self, reason: str):
+        if not self.head:
+            return
+        size = len(self.events)
+        events = [self.events[i % size] for i in range(max(0, self.head - size), self.head)]
+        lines = [json.dumps({'dump': reason, 'turn': self.turn})]
+        lines += [json.dumps(e, default=str) for e in events]
+        # stdout belongs to the game protocol
+        if TRACE_FILE:
+            with open(TRACE_FILE, 'a') as out:
+                out.write('\n'.join(lines) + '\n')
+        else:
+            sys.stderr.write('\n'.join(lines) + '\n')
+        self.head = 0
+
+
+# endregion
+
+# region capture
+
+# a min-heap on the turn time, so the fastest of the kept turns is the one replaced
+class SlowTurns:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.heap = []
+
+    def push(self, elapsed: float, turn: int, raw: str):
+        if len(self.heap) < self.capacity:
+            heapq.heappush(self.heap, (elapsed, turn, raw))
+        elif elapsed > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (elapsed, turn, raw))
+
+    def write(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for elapsed, turn, raw in self.heap:
+            data = json.loads(raw)
+            data['Timing'] = {'Milliseconds': round(elapsed, 3), 'Turn': turn}
+            with open(os.path.join(directory, f'{uuid.uuid4()}.json'), 'w') as out:
+                json.dump(data, out)
+        self.heap.clear()
+
+
+# endregion
+
+# region sampling profiler
+
+# Stacks of make_turn sampled on SIGALRM at a fixed interval of wall time: the CPU-time timers
+# only fire on scheduler ticks, coarser than a whole turn, and the latency includes the waits
+# anyway. A sample only walks the frames up to make_turn and counts the code objects, names are
+# formatted when the turns are written, one collapsed-stack file per kept turn.
+class SamplingProfiler:
+    def __init__(self, interval_us: int, slow_ms: float):
+        self.interval = interval_us / 1e6
+        self.slow_ms = slow_ms
+        self.game = uuid.uuid4().hex[:8]
+        self.samples = {}
+        self.turns = []
+
+    def sample(self, frame):
+        root = make_turn.__code__
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            if frame.f_code is root:
+                break
+            frame = frame.f_back
+        stack = tuple(stack)
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def start(self):
+        global profile_handler_installed
+        if not profile_handler_installed:
+            signal.signal(signal.SIGALRM, profile_sample)
+            profile_handler_installed = True
+        self.samples = {}
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+    # turns faster than the threshold are dropped with their samples
+    def stop(self, turn: int, elapsed: float):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        if elapsed >= self.slow_ms and self.samples:
+            self.turns.append((turn, elapsed, self.samples))
+        self.samples = {}
+
+    def write(self, directory: str):
+        if not self.turns:
+            return
+        os.makedirs(directory, exist_ok=True)
+        for turn, elapsed, samples in self.turns:
+            path = os.path.join(directory, f'{self.game}-turn{turn:04d}-{elapsed:.0f}ms.folded')
+            with open(path, 'w') as out:
+                for stack, count in samples.items():
+                    frames = ';'.join(f'{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})'
+                                      for c in reversed(stack))
+                    out.write(f'{frames} {count}\n')
+        self.turns.clear()
+
+
+# One handler for the process: the server runs many games, and the timer only runs during a
+# turn, while that game's session is the current one.
+def profile_sample(signum, frame):
+    profiler = session.profiler
+    if profiler is not None:
+        profiler.sample(frame)
+
+
+profile_handler_installed = False
+
+
+# endregion
+
+# region decision cache
+
+def bucket(value: Optional[int], size: int) -> Optional[int]:
+    return None if value is None else value // size
+
+
+# Everything make_turn looks at, relative to the first own ship. Distances to the walls are
+# clipped to what a ship can reach this turn, so translated copies of a state away from the
+# walls share a fingerprint.
+def fingerprint(battle_state: BattleState, target: Ship) -> tuple:
+    anchor = battle_state.My[0].Position
+    ax, ay, az = anchor.X, anchor.Y, anchor.Z
+    size, ship_size = session.map_size, session.ship_size
+    my = []
+    for ship in battle_state.My:
+        p, v = ship.Position, ship.Velocity
+        # a wall matters as far as the ship can get before it stops, which is what can_stop checks
+        engine = next((e for e in ship.Equipment or [] if isinstance(e, EngineBlock)), None)
+        speed = max(abs(v.X), abs(v.Y), abs(v.Z)) + (engine.MaxAccelerate if engine is not None else 0)
+        brake = reach_table(engine.MaxAccelerate).brake.get(speed) if engine is not None else 0
+        horizon = size if brake is None else speed + abs(brake) + 4 * ship_size
+        guns = [e for e in ship.Equipment or [] if isinstance(e, GunBlock)]
+        price = min((g.EnergyPrice for g in guns if g.EnergyPrice), default=0)
+        my.append((
+            ship.Id, p.X - ax, p.Y - ay, p.Z - az, v.X, v.Y, v.Z, bucket(ship.Health, HEALTH_BUCKET),
+            ship.Energy if not price or ship.Energy is None else min(len(guns), ship.Energy // price),
+            tuple(min(c, horizon) for c in (p.X, p.Y, p.Z, size - p.X, size - p.Y, size - p.Z)),
+        ))
+    opponents = tuple(sorted(
+        (o.Id, o.Position.X - ax, o.Position.Y - ay, o.Position.Z - az,
+         o.Velocity.X, o.Velocity.Y, o.Velocity.Z, bucket(o.Health, HEALTH_BUCKET))
+        for o in battle_state.Opponent
+    ))
+    fires = tuple(sorted((f.Target.X - ax, f.Target.Y - ay, f.Target.Z - az) for f in battle_state.FireInfos))
+    return target.Id, tuple(my), opponents, fires
+
+
+class DecisionCache:
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.lookups = 0
+
+    def get(self, key: tuple, anchor: Vector) -> Optional[List[UserCommand]]:
+        self.lookups += 1
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        commands = []
+        for name, ship_id, gun, vector in entry:
+            if name == 'MOVE':
+                commands.append(move_command(ship_id, anchor + vector))
+            elif name == 'ATTACK':
+                commands.append(attack_command(ship_id, gun, anchor + vector))
+            else:
+                commands.append(accelerate_command(ship_id, vector))
+        return commands
+
+    def put(self, key: tuple, anchor: Vector, commands: List[UserCommand]):
+        # positions are stored relative to the anchor, accelerations as they are
+        self.entries[key] = [
+            (c.Command, c.Parameters.Id, getattr(c.Parameters, 'Name', None),
+             c.Parameters.Vector if c.Command == 'ACCELERATE' else c.Parameters.Target - anchor)
+            for c in commands
+        ]
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> str:
+        return f'{self.hits}/{self.lookups}'
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.lookups = 0
+
+
+# endregion
+
+
+# region search
+
+# The search plays whole fleets: an action is one intent for every ship of a side plus the
+# opponent its guns focus on, so the branching factor does not grow with the fleet size.
+INTENTS = ('greedy', 'close', 'drift', 'open')
+FOCUS_WIDTH = 2
+ALIVE_WEIGHT = 20
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def clamp(value: int, limit: int) -> int:
+    return max(-limit, min(limit, value))
+
+
+# ships of the search are plain tuples: (Id, position, velocity, health, step, damage, radius)
+def search_fleets(battle_state: BattleState) -> tuple:
+    mine = []
+    for ship in battle_state.My:
+        equipment = ship.Equipment or []
+        engine = next(filter(lambda e: isinstance(e, EngineBlock), equipment), None)
+        guns = [e for e in equipment if isinstance(e, GunBlock)]
+        energy = next(filter(lambda e: isinstance(e, EnergyBlock), equipment), None)
+        damage = sum(g.Damage for g in guns)
+        price = sum(g.EnergyPrice or 0 for g in guns)
+        if energy is not None and price > energy.IncrementPerTurn:
+            # sustained fire is bounded by the energy income
+            damage = damage * energy.IncrementPerTurn // price
+        p, v = ship.Position, ship.Velocity
+        mine.append((ship.Id, (p.X, p.Y, p.Z), (v.X, v.Y, v.Z), ship.Health or 0,
+                     engine.MaxAccelerate if engine is not None else 0, damage,
+                     max((g.Radius for g in guns), default=0)))
+
+    # opponent equipment is hidden, they are assumed to be built like our strongest ship, with at
+    # least the reach their shots have shown
+    _, _, _, _, step, damage, radius = max(mine, key=lambda s: (s[5], s[4]), default=(0, 0, 0, 0, 1, 0, 0))
+    radius = max(radius, session.threats.reach - session.ship_size)
+    theirs = [(o.Id, (o.Position.X, o.Position.Y, o.Position.Z), (o.Velocity.X, o.Velocity.Y, o.Velocity.Z),
+               o.Health or 0, step, damage, radius) for o in battle_state.Opponent]
+    return tuple(mine), tuple(theirs)
+
+
+def intent_acceleration(ship: tuple, intent: str, focus: tuple, planned: dict) -> tuple:
+    _, p, v, _, step, _, _ = ship
+    if intent == 'greedy' and ship[0] in planned:
+        goal = planned[ship[0]]
+    elif intent == 'close':
+        goal = focus[1]
+    elif intent == 'open':
+        goal = tuple(2 * c - f for c, f in zip(p, focus[1]))
+    else:
+        goal = tuple(c + d for c, d in zip(p, v))
+    return tuple(clamp(g - c - d, step) for g, c, d in zip(goal, p, v))
+
+
+class Zobrist:
+    def __init__(self, seed: int = 0x5eed):
+        self.random = random.Random(seed)
+        self.keys = {}
+
+    def key(self, feature: tuple) -> int:
+        key = self.keys.get(feature)
+        if key is None:
+            key = self.keys[feature] = self.random.getrandbits(64)
+        return key
+
+    def hash(self, fleets: tuple) -> int:
+        key, h = self.key, 0
+        for ship in fleets[0] + fleets[1]:
+            h ^= key((ship[0], 0) + ship[1]) ^ key((ship[0], 1) + ship[2]) ^ key((ship[0], 2, ship[3]))
+        return h
+
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+# Entries outlive the turn: after a predicted reply the new root is already in the table.
+class TranspositionTable:
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = {}
+
+    def get(self, key: int) -> Optional[tuple]:
+        return self.entries.get(key)
+
+    def put(self, key: int, depth: int, value: float, bound: int, action: tuple):
+        if len(self.entries) >= self.size and key not in self.entries:
+            self.entries.clear()
+        self.entries[key] = (depth, value, bound, action)
+
+
+class Search:
+    def __init__(self, fleets: tuple, planned: dict, target_id: int, deadline: float,
+                 table: TranspositionTable, zobrist: Zobrist):
+        self.root = fleets
+        self.planned = planned
+        self.target_id = target_id
+        self.deadline = deadline
+        self.table = table
+        self.zobrist = zobrist
+        self.nodes = 0
+        self.limit = session.map_size - 1 - session.ship_size
+
+    def actions(self, fleet: tuple, enemies: tuple, root: bool, preferred: Optional[int]) -> List[tuple]:
+        if not fleet or not enemies:
+            return [('hold', None)]
+        anchor = fleet[0][1]
+        focus = sorted(enemies, key=lambda e: (e[0] != preferred, max(abs(a - b) for a, b in zip(anchor, e[1])),
+                                               e[3]))[:FOCUS_WIDTH]
+        intents = INTENTS if root else INTENTS[1:]
+        # intents in the greedy order first, so the first line searched is the heuristic's move
+        return [(intent, e[0]) for intent in intents for e in focus]
+
+    # the acceleration and the focused opponent (or None) of every ship of the fleet
+    def orders(self, fleet: tuple, action: tuple, enemies: tuple) -> List[Tuple[tuple, Optional[tuple]]]:
+        intent, focus_id = action
+        focus = next((e for e in enemies if e[0] == focus_id), None)
+        if focus is None:
+            return [(tuple(clamp(-d, ship[4]) for d in ship[2]), None) for ship in fleet]
+        return [(intent_acceleration(ship, intent, focus, self.planned), focus) for ship in fleet]
+
+    # shots are aimed where a ship drifts to, so a ship whose acceleration leaves that box dodges
+    def advance(self, fleet: tuple, action: tuple, enemies: tuple) -> Tuple[tuple, dict, set]:
+        limit, ship_size = self.limit, session.ship_size
+        moved, damage, dodged = [], {}, set()
+        for ship, (a, focus) in zip(fleet, self.orders(fleet, action, enemies)):
+            ship_id, p, v, health, step, gun, radius = ship
+            # aimed at the middle of the box, a shot reaches half a ship further than the radius
+            if focus is not None and gun and max(abs(c - f) for c, f in zip(p, focus[1])) <= radius + ship_size // 2:
+                damage[focus[0]] = damage.get(focus[0], 0) + gun
+            if any(e > 0 or e < -ship_size for e in a):
+                dodged.add(ship_id)
+            v = tuple(d + e for d, e in zip(v, a))
+            moved_p = tuple(c + d for c, d in zip(p, v))
+            v = tuple(d if 0 <= c <= limit else 0 for c, d in zip(moved_p, v))
+            moved.append((ship_id, tuple(max(0, min(limit, c)) for c in moved_p), v, health, step, gun, radius))
+        return tuple(moved), damage, dodged
+
+    # both sides move and fire at the same time, like the referee resolves a turn
+    def resolve(self, fleets: tuple, mine: tuple, theirs: tuple) -> tuple:
+        my_fleet, my_damage, my_dodged = self.advance(fleets[0], mine, fleets[1])
+        their_fleet, their_damage, their_dodged = self.advance(fleets[1], theirs, fleets[0])
+        for ship_id in my_dodged:
+            their_damage.pop(ship_id, None)
+        for ship_id in their_dodged:
+            my_damage.pop(ship_id, None)
+        return (
+            tuple(s[:3] + (s[3] - their_damage.get(s[0], 0),) + s[4:] for s in my_fleet
+                  if s[3] > their_damage.get(s[0], 0)),
+            tuple(s[:3] + (s[3] - my_damage.get(s[0], 0),) + s[4:] for s in their_fleet
+                  if s[3] > my_damage.get(s[0], 0)),
+        )
+
+    @staticmethod
+    def evaluate(fleets: tuple) -> float:
+        mine, theirs = fleets
+        return sum(s[3] for s in mine) - sum(s[3] for s in theirs) + ALIVE_WEIGHT * (len(mine) - len(theirs))
+
+    def key(self, fleets: tuple):
+        return self.zobrist.hash(fleets)
+
+    def tick(self):
+        self.nodes += 1
+        if not self.nodes & 15 and time.perf_counter() > self.deadline:
+            raise SearchTimeout
+
+    # our side chooses, then the opponent replies knowing our choice
+    def max_value(self, fleets: tuple, depth: int, alpha: float, beta: float, root: bool) -> Tuple[float, tuple]:
+        self.tick()
+        if depth == 0 or not fleets[0] or not fleets[1]:
+            return self.evaluate(fleets), None
+
+        key = self.key(fleets)
+        entry = self.table.get(key)
+        best_action = None
+        if entry is not None:
+            entry_depth, value, bound, best_action = entry
+            if entry_depth >= depth and not root:
+                if bound == EXACT or bound == LOWER and value >= beta or bound == UPPER and value <= alpha:
+                    return value, best_action
+
+        actions = self.actions(fleets[0], fleets[1], root, self.target_id)
+        if best_action in actions:
+            actions.remove(best_action)
+            actions.insert(0, best_action)
+
+        start_alpha, best_value, best_action = alpha, float('-inf'), actions[0]
+        for action in actions:
+            value = self.min_value(fleets, action, depth, alpha, beta)
+            if value > best_value:
+                best_value, best_action = value, action
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        bound = LOWER if best_value >= beta else UPPER if best_value <= start_alpha else EXACT
+        self.table.put(key, depth, best_value, bound, best_action)
+        return best_value, best_action
+
+    def min_value(self, fleets: tuple, mine: tuple, depth: int, alpha: float, beta: float) -> float:
+        best_value = float('inf')
+        for theirs in self.actions(fleets[1], fleets[0], False, None):
+            value, _ = self.max_value(self.resolve(fleets, mine, theirs), depth - 1, alpha, beta, False)
+            best_value = min(best_value, value)
+            beta = min(beta, value)
+            if alpha >= beta:
+                break
+        return best_value
+
+    # iterative deepening: the last depth that finished before the deadline decides
+    def run(self, max_depth: int) -> Tuple[Optional[tuple], int]:
+        best, reached = None, 0
+        for depth in range(1, max_depth + 1):
+            try:
+                _, best = self.max_value(self.root, depth, float('-inf'), float('inf'), True)
+            except SearchTimeout:
+                break
+            reached = depth
+        return best, reached
+
+
+# the focus and per-ship accelerations the search prefers, or no accelerations to keep the greedy moves
+def search_plan(battle_state: BattleState, planned: dict, target: Ship,
+                deadline: float) -> Tuple[Ship, Optional[dict]]:
+    fleets = search_fleets(battle_state)
+    search = Search(fleets, {i: (v.X, v.Y, v.Z) for i, v in planned.items()}, target.Id, deadline,
+                    session.transpositions, zobrist)
+    action, depth = search.run(SEARCH_DEPTH)
+    if session.trace.active:
+        session.trace.record('search', action, depth, search.nodes)
+    if action is None or action[0] == 'greedy':
+        return target, None
+
+    intent, focus_id = action
+    focus = next(o for o in battle_state.Opponent if o.Id == focus_id)
+    enemy = next(e for e in fleets[1] if e[0] == focus_id)
+    return focus, {ship[0]: Vector(*intent_acceleration(ship, intent, enemy, search.planned))
+                   for ship in fleets[0] if ship[4]}
+
+
+zobrist = Zobrist()
+
+
+# endregion
+
+
+# region endgame
+
+# With few ships left the search drops the fleet intents and plays the accelerations of every
+# ship, the ENDGAME_WIDTH best by the greedy score. Positions are memoized up to translation and
+# axis permutation, the symmetries of the Chebyshev grid and of the footprint boxes; the walls are
+# left out of the memo key, so a position near a wall shares its value with the same position in
+# open space.
+class Endgame(Search):
+    def __init__(self, fleets: tuple, deadline: float, table: TranspositionTable):
+        super().__init__(fleets, {}, None, deadline, table, zobrist)
+        self.ship_order_cache = {}
+
+    # The axes are put in the order of their columns, the relative positions and velocities of the
+    # ships in fleet order. Equal columns can be swapped freely, so one sort finds the permutation
+    # instead of trying all six.
+    def key(self, fleets: tuple) -> tuple:
+        ships = fleets[0] + fleets[1]
+        columns = []
+        for k in range(3):
+            low = min(s[1][k] for s in ships)
+            columns.append(tuple((s[1][k] - low, s[2][k]) for s in ships))
+        axes = sorted(range(3), key=columns.__getitem__)
+        return ('endgame',) + tuple(
+            tuple(sorted(tuple(zip(*(columns[k][i] for k in axes))) + s[3:] for i, s in enumerate(fleet, start)))
+            for start, fleet in ((0, fleets[0]), (len(fleets[0]), fleets[1]))
+        )
+
+    # ties in health are broken by how close our ships are to the desired range of an opponent
+    @staticmethod
+    def evaluate(fleets: tuple) -> float:
+        mine, theirs = fleets
+        value = Search.evaluate(fleets)
+        if mine and theirs:
+            ring = session.params['ring']
+            value -= 0.01 * sum(min(abs(max(abs(c - f) for c, f in zip(s[1], e[1])) - ring) for e in theirs)
+                                for s in mine)
+        return value
+
+    # Dodging first, they are the ones that usually survive, then the nearest to the desired
+    # range of an opponent's drift with the least speed left to brake.
+    @staticmethod
+    def greedy(ship: tuple, enemies: tuple, a: tuple) -> tuple:
+        _, p, v, _, _, _, _ = ship
+        ring, ship_size = session.params['ring'], session.ship_size
+        velocity = tuple(d + e for d, e in zip(v, a))
+        moved = tuple(c + d for c, d in zip(p, velocity))
+        distance = min((abs(max(abs(c - f - g) for c, f, g in zip(moved, e[1], e[2])) - ring) for e in enemies),
+                       default=0)
+        return not any(e > 0 or e < -ship_size for e in a), distance + max(map(abs, velocity))
+
+    def ship_orders(self, ship: tuple, enemies: tuple, root: bool) -> List[tuple]:
+        key = ship, enemies, root
+        orders = self.ship_order_cache.get(key)
+        if orders is None:
+            orders = self.ship_order_cache[key] = self.plain_ship_orders(ship, enemies, root)
+        return orders
+
+    def plain_ship_orders(self, ship: tuple, enemies: tuple, root: bool) -> List[tuple]:
+        _, p, v, _, step, gun, radius = ship
+        accelerations = list(product(range(-step, step + 1), repeat=3))
+        if root:
+            limit = self.limit
+            accelerations = [a for a in accelerations
+                             if all(0 <= c + d + e <= limit for c, d, e in zip(p, v, a))] or [(0, 0, 0)]
+        accelerations = sorted(accelerations, key=lambda a: self.greedy(ship, enemies, a))[:ENDGAME_WIDTH]
+        reach = radius + session.ship_size // 2
+        targets = [e[0] for e in enemies if gun and max(abs(c - f) for c, f in zip(p, e[1])) <= reach]
+        targets = sorted(targets, key=lambda i: next(e[3] for e in enemies if e[0] == i)) or [None]
+        return [(a, i) for a in accelerations for i in targets]
+
+    def actions(self, fleet: tuple, enemies: tuple, root: bool, preferred: Optional[int]) -> List[tuple]:
+        if not fleet or not enemies:
+            return [()]
+        return list(product(*(self.ship_orders(ship, enemies, root) for ship in fleet)))
+
+    def orders(self, fleet: tuple, action: tuple, enemies: tuple) -> List[Tuple[tuple, Optional[tuple]]]:
+        if not action:
+            return [(tuple(clamp(-d, ship[4]) for d in ship[2]), None) for ship in fleet]
+        by_id = {e[0]: e for e in enemies}
+        return [(a, by_id.get(i)) for a, i in action]
+
+
+# The exact per-ship plan, or None when not even one turn was searched in time. The search is
+# not started when every reply to every root action, the first depth without pruning, would not
+# fit the time left at the node rate of the previous endgame turns.
+def endgame_plan(battle_state: BattleState, deadline: float) -> Optional[List[UserCommand]]:
+    fleets = search_fleets(battle_state)
+    endgame = Endgame(fleets, deadline, session.transpositions)
+    started = time.perf_counter()
+    mine, theirs = endgame.actions(fleets[0], fleets[1], True, None), endgame.actions(fleets[1], fleets[0], False, None)
+    if len(mine) * len(theirs) > session.endgame_rate * (deadline - started):
+        if session.trace.active:
+            session.trace.record('endgame', None, 0, 0)
+        return None
+    action, depth = endgame.run(SEARCH_DEPTH)
+    elapsed = time.perf_counter() - started
+    if elapsed > 0 and endgame.nodes:
+        session.endgame_rate = endgame.nodes / elapsed
+    if session.trace.active:
+        session.trace.record('endgame', action, depth, endgame.nodes)
+    if not action:
+        return None
+
+    commands = [accelerate_command(ship[0], Vector(*a)) for ship, (a, _) in zip(fleets[0], action) if ship[4]]
+    focus = [i for _, i in action if i is not None]
+    if focus:
+        target = next(o for o in battle_state.Opponent if o.Id == focus[0])
+        commands += allocate_fire(battle_state, target)
+    return commands
+
+
+# endregion
+
+
+# region opening book
+
+def tupled(value):
+    return tuple(map(tupled, value)) if isinstance(value, list) else value
+
+
+# Moves of the first turns planned offline by make_book.py, stored like decision cache entries.
+# The key is the draft and our own formation only: the server draws the opponents' placement, so
+# a key with their positions would only ever repeat against another formation. Guns are aimed
+# live, and the first shot of the game leaves the book.
+class OpeningBook(DecisionCache):
+    def __init__(self):
+        super().__init__(float('inf'))
+
+    @staticmethod
+    def key(battle_state: BattleState) -> tuple:
+        return 'opening', session.map_size, tuple(sorted(
+            (s.Id, s.Position.X, s.Position.Y, s.Position.Z, s.Velocity.X, s.Velocity.Y, s.Velocity.Z)
+            for s in battle_state.My
+        ))
+
+    def put(self, key: tuple, anchor: Vector, commands: List[UserCommand]):
+        super().put(key, anchor, [c for c in commands if c.Command != 'ATTACK'])
+
+    def save(self, path: str):
+        rows = [[key, [(name, ship_id, gun, [v.X, v.Y, v.Z]) for name, ship_id, gun, v in entry]]
+                for key, entry in self.entries.items()]
+        with gzip.open(path, 'wt') as out:
+            json.dump(rows, out, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: str) -> Optional['OpeningBook']:
+        if not os.path.exists(path):
+            return None
+        book = cls()
+        with gzip.open(path, 'rt') as inp:
+            for key, entry in json.load(inp):
+                book.entries[tupled(key)] = [(name, ship_id, gun, Vector(*v)) for name, ship_id, gun, v in entry]
+        return book
+
+
+# With a book the fleet is placed in a fixed formation, the start area slots nearest to the map
+# centre, so that the opening positions repeat from match to match.
+def formation(options: DraftOptions, count: int) -> List[Vector]:
+    ship_size = session.ship_size
+    low, high = options.StartArea.get('From'), options.StartArea.get('To')
+    if low is None or high is None:
+        return []
+    slots = [Vector(*p) for p in product(*(range(a, b - ship_size + 1, ship_size + 1) for a, b in
+                                           ((low.X, high.X), (low.Y, high.Y), (low.Z, high.Z))))]
+    centre = Vector(*[options.MapSize // 2] * 3)
+    return sorted(slots, key=lambda v: (v.clen(centre), v.X, v.Y, v.Z))[:count]
+
+
+# endregion
+
+
+# region ensemble
+
+def planner_worker(module_name: str, connection):
+    # stdout belongs to the game protocol, a planner never writes to it from here
+    sys.stdout = sys.stderr
+    try:
+        module = importlib.import_module(module_name)
+    except Exception as error:
+        # the closed pipe tells the ensemble to play without this planner
+        sys.stderr.write(f'planner {module_name} unavailable: {error!r}\n')
+        return
+    while True:
+        try:
+            kind, turn, data = connection.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            output = module.make_draft(data) if kind == 'draft' else module.make_turn(data)
+            output = json.loads(json.dumps(output, default=lambda x: x.to_json()))
+        except Exception:
+            output = None
+        try:
+            connection.send((turn, output))
+        except OSError:
+            break
+
+
+# not pooled, the pooled commands of our own plan must survive until the plans are compared
+def parse_command(command: dict) -> Optional[UserCommand]:
+    try:
+        name, parameters = command['Command'], command['Parameters']
+        if name == 'MOVE':
+            return UserCommand(name, MoveCommandParameters(parameters['Id'], Vector.from_json(parameters['Target'])))
+        if name == 'ATTACK':
+            return UserCommand(name, AttackCommandParameters(parameters['Id'], parameters['Name'],
+                                                             Vector.from_json(parameters['Target'])))
+        if name == 'ACCELERATE':
+            return UserCommand(name, AccelerateCommandParameters(parameters['Id'],
+                                                                 Vector.from_json(parameters['Vector'])))
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+# The common yardstick of all planners, one turn ahead: damage that lands on where the opponents
+# drift to and kills, against the replies our plan leaves open. Opponents aim at our drift too,
+# so a ship that does not accelerate out of that box takes a shot from every opponent within the
+# reach their shots have shown, and one left inside last turn's fire footprints takes another.
+# Health decides; the place a ship is left in breaks the ties, a tenth of a point per cell off
+# the desired range of the nearest opponent and per unit of speed, and a ship that can no longer
+# stop before a wall pays for a shot.
+def evaluate_plan(battle_state: BattleState, commands: List[UserCommand], boxes: Boxes) -> float:
+    my = {ship.Id: ship for ship in battle_state.My}
+    health = {o.Id: o.Health or 0 for o in battle_state.Opponent}
+    drift = [(o.Id, o.Position + o.Velocity) for o in battle_state.Opponent]
+    energy = {ship.Id: ship.Energy for ship in battle_state.My}
+    accelerations = {}
+    ship_size = session.ship_size
+
+    value = 0.0
+    for command in commands:
+        ship = my.get(command.Parameters.Id)
+        if ship is None:
+            continue
+        equipment = ship.Equipment or []
+        if command.Command == 'ATTACK':
+            gun = next((e for e in equipment if isinstance(e, GunBlock) and e.Name == command.Parameters.Name), None)
+            aim = command.Parameters.Target
+            if gun is None or not can_fire(energy[ship.Id], gun) or shot_range(ship.Position, aim) > gun.Radius:
+                continue
+            if energy[ship.Id] is not None:
+                energy[ship.Id] -= gun.EnergyPrice or 0
+            for opponent_id, p in drift:
+                if health[opponent_id] > 0 and 0 <= aim.X - p.X <= ship_size and 0 <= aim.Y - p.Y <= ship_size \
+                        and 0 <= aim.Z - p.Z <= ship_size:
+                    value += min(gun.Damage, health[opponent_id])
+                    health[opponent_id] -= gun.Damage
+                    value += ALIVE_WEIGHT * (health[opponent_id] <= 0)
+        else:
+            engine = next(filter(lambda e: isinstance(e, EngineBlock), equipment), None)
+            step = engine.MaxAccelerate if engine is not None else 0
+            if command.Command == 'MOVE':
+                a = command.Parameters.Target - ship.Position - ship.Velocity
+            else:
+                a = command.Parameters.Vector
+            accelerations[ship.Id] = Vector(clamp(a.X, step), clamp(a.Y, step), clamp(a.Z, step))
+
+    # opponent guns are hidden, a shot is assumed to be our strongest
+    damage = max((sum(g.Damage for g in ship.Equipment or [] if isinstance(g, GunBlock)) for ship in my.values()),
+                 default=0)
+    gun_reach = max(session.threats.reach, max((g.Radius for ship in my.values() for g in ship.Equipment or []
+                                                if isinstance(g, GunBlock)), default=0) + ship_size)
+    ring = session.params['ring']
+    for ship in my.values():
+        a = accelerations.get(ship.Id, Vector(0, 0, 0))
+        aimed = ship.Position + ship.Velocity
+        velocity = ship.Velocity + a
+        position = aimed + a
+        shots = 0
+        if all(-ship_size <= c <= 0 for c in (a.X, a.Y, a.Z)):
+            shots += sum(o.Position.clen(aimed) <= gun_reach for o in battle_state.Opponent)
+        shots += position in boxes
+        value -= min(damage * shots, ship.Health or 0)
+
+        engine = next(filter(lambda e: isinstance(e, EngineBlock), ship.Equipment or []), None)
+        step = engine.MaxAccelerate if engine is not None else 0
+        if not position.in_bounds() or not reach_table(step).can_stop(position, velocity):
+            value -= min(damage, ship.Health or 0)
+        value -= 0.1 * max(abs(velocity.X), abs(velocity.Y), abs(velocity.Z))
+        value -= 0.1 * min((abs(position.clen(p) - ring) for _, p in drift), default=0)
+    return value
+
+
+# Planner modules run in worker processes on the same raw state while this process plans
+# itself. Whatever came back before the deadline is scored and the best plan is played; a
+# worker still busy with an earlier turn gets no new state until it answers.
+class Ensemble:
+    def __init__(self, modules: List[str]):
+        self.workers = []
+        for name in modules:
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=planner_worker, args=(name, child), daemon=True)
+            process.start()
+            self.workers.append((name, process, parent))
+        self.busy = set()
+        self.turn = 0
+        self.wins = {name: 0 for name in ['merged'] + modules}
+
+    # a worker that died or closed its pipe is left out for the rest of the game
+    def drop(self, connection):
+        self.busy.discard(connection)
+        for worker in [w for w in self.workers if w[2] is connection]:
+            self.workers.remove(worker)
+            sys.stderr.write(f'planner {worker[0]} dropped\n')
+            connection.close()
+            worker[1].join(0.1)
+            if worker[1].is_alive():
+                worker[1].terminate()
+
+    def receive(self, connection) -> Optional[tuple]:
+        try:
+            return connection.recv()
+        except (EOFError, OSError):
+            self.drop(connection)
+            return None
+
+    def send(self, kind: str, data: dict):
+        # late answers to earlier turns free their workers
+        for connection in wait(list(self.busy), 0):
+            if self.receive(connection) is not None:
+                self.busy.discard(connection)
+        self.turn += 1
+        for _, _, connection in list(self.workers):
+            if connection not in self.busy:
+                try:
+                    connection.send((kind, self.turn, data))
+                except OSError:
+                    self.drop(connection)
+                    continue
+                self.busy.add(connection)
+
+    def collect(self, deadline: float) -> List[Tuple[str, dict]]:
+        names = {connection: name for name, _, connection in self.workers}
+        results = []
+        while self.busy:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                break
+            for connection in wait(list(self.busy), left):
+                reply = self.receive(connection)
+                if reply is None:
+                    continue
+                turn, output = reply
+                self.busy.discard(connection)
+                if turn == self.turn and output is not None:
+                    results.append((names[connection], output))
+        return results
+
+    def choose(self, battle_state: BattleState, own: BattleOutput, deadline: float) -> BattleOutput:
+        boxes = fire_boxes(battle_state)
+        best_name, best = 'merged', own
+        best_value = evaluate_plan(battle_state, own.UserCommands, boxes)
+        for name, output in self.collect(deadline):
+            commands = [c for c in map(parse_command, output.get('UserCommands') or []) if c is not None]
+            value = evaluate_plan(battle_state, commands, boxes)
+            if value > best_value:
+                best_name, best_value = name, value
+                best = BattleOutput(UserCommands=commands)
+        self.wins[best_name] += 1
+        if session.trace.active:
+            session.trace.record('ensemble', best_name, best_value)
+        if best is not own:
+            own.UserCommands[:] = best.UserCommands
+        return own
+
+    def close(self):
+        for _, process, connection in self.workers:
+            connection.close()
+            process.join(0.1)
+            if process.is_alive():
+                process.terminate()
+
+
+# endregion
+
+
+# region session
+
+# Everything that belongs to one game. The stdin/stdout bot has a single session, the server
+# switches the module-level session before handling each game's line.
+class Session:
+    def __init__(self, params: Optional[dict] = None):
+        self.params = {**PARAMS, **(params or {})}
+        self.target = None
+        self.map_size = MAP_SIZE
+        self.ship_size = self.params['ship_size']
+        self.player_id = 0
+        self.threats = ThreatTracker(5)
+        self.decision_cache = DecisionCache(DECISION_CACHE_SIZE) if DECISION_CACHE_SIZE > 0 else None
+        self.pool = TurnPool() if POOLING else None
+        self.trace = DecisionTrace(TRACE_CAPACITY, TRACE_EVERY)
+        self.slow_turns = SlowTurns(CAPTURE_SLOWEST) if CAPTURE_SLOWEST > 0 else None
+        self.profiler = SamplingProfiler(PROFILE_US, PROFILE_SLOW_MS) \
+            if PROFILE_US > 0 and hasattr(signal, 'setitimer') else None
+        self.ensemble = None
+        self.opponent = OPPONENT
+        self.profile = None
+        self.book = opening_book
+        self.in_book = opening_book is not None
+        self.transpositions = TranspositionTable(TRANSPOSITION_SIZE)
+        self.endgame_rate = ENDGAME_RATE
+        self.move_weights = move_weights
+        self.max_time = None
+        self.max_time_move = 1
+        self.moves_count = 1
+        self.drafted = False
+
+
+move_weights = load_move_weights(MOVE_WEIGHTS_FILE)
+opening_book = OpeningBook.load(BOOK_FILE)
+session = Session()
+
+
+# endregion
+
+# region warmup
+
+offset_tables = {}
+
+
+def step_offsets(step: int) -> List[Vector]:
+    offsets = offset_tables.get(step)
+    if offsets is None:
+        offsets = offset_tables[step] = [Vector(*p) for p in product((0, step, -step), repeat=3)]
+    return offsets
+
+
+# Equal scores keep the candidate order, so the order must not favour a direction: the least
+# acceleration first, then the nearest to the map centre, then by the offsets from the centre per
+# axis, all unchanged by mirroring the map.
+def neutral_key(drift: Vector, v: Vector) -> tuple:
+    centre = session.map_size - 1 - session.ship_size
+    a = v - drift
+    offsets = abs(2 * v.X - centre), abs(2 * v.Y - centre), abs(2 * v.Z - centre)
+    return a.X * a.X + a.Y * a.Y + a.Z * a.Z, sum(o * o for o in offsets), offsets
+
+
+def dummy_state(options: DraftOptions, choice: DraftChoice) -> Optional[dict]:
+    blocks = {e.Equipment.Name: e.Equipment for e in options.Equipment}
+    complete_ships = {s.Id: s for s in options.CompleteShips}
+    chosen = [complete_ships.get(s.CompleteShipId) for s in choice.Ships]
+    if not chosen or None in chosen or any(name not in blocks for s in chosen for name in s.Equipment):
+        return None
+
+    ship_size = session.ship_size
+    low, high = 1, session.map_size - ship_size - 1
+    start = next(iter(options.StartArea.values()), Vector(low, low, low))
+    my, opponent = [], []
+    for i, complete_ship in enumerate(chosen):
+        equipment = [blocks[name] for name in complete_ship.Equipment]
+        x = max(low, min(high, start.X + i * (ship_size + 1)))
+        y, z = max(low, min(high, start.Y)), max(low, min(high, start.Z))
+        my.append({
+            'Id': -1 - i, 'Position': f'{x}/{y}/{z}', 'Velocity': '0/0/0',
+            'Energy': sum(e.StartEnergy for e in equipment if isinstance(e, EnergyBlock)),
+            'Health': sum(e.StartHealth for e in equipment if isinstance(e, HealthBlock)),
+            'Equipment': [e.to_json() for e in equipment],
+        })
+        opponent.append({
+            'Id': -1001 - i, 'Position': f'{low + high - x}/{low + high - y}/{low + high - z}',
+            'Velocity': '0/0/0', 'Health': my[-1]['Health'],
+        })
+    fires = [{'Source': opponent[0]['Position'], 'Target': my[0]['Position'], 'EffectType': 0}]
+    return {'My': my, 'Opponent': opponent, 'FireInfos': fires}
+
+
+# Builds every table the battle needs while the draft timeout is still running and plays a
+# throwaway turn so that turn 1 does not pay for cold paths either.
+def warmup(options: DraftOptions, choice: DraftChoice):
+    steps = {e.Equipment.MaxAccelerate for e in options.Equipment if isinstance(e.Equipment, EngineBlock)}
+    for step in steps | {1}:
+        step_offsets(step)
+        reach_table(step)
+    grid = bit_grid() if DISTANCE_FIELDS else None
+    if grid is not None:
+        grid.box(Vector(0, 0, 0), session.ship_size)
+    if session.pool is not None:
+        session.pool.new_turn()
+
+    # both passes plan: a cache or book hit on the second would skip the paths it should warm
+    data = dummy_state(options, choice)
+    if data is not None:
+        decision_cache, session.decision_cache, session.in_book = session.decision_cache, None, False
+        for _ in range(2):
+            json.dumps(make_turn(data), default=lambda x: x.to_json(), ensure_ascii=False)
+        session.decision_cache = decision_cache
+
+    # nothing of the throwaway game may leak into the real one
+    session.target = None
+    session.threats = ThreatTracker(options.MaxShipsCount, session.profile)
+    if session.decision_cache is not None:
+        session.decision_cache.clear()
+    if session.pool is not None:
+        session.pool.ships.clear()
+    session.trace.head = 0
+    session.transpositions.entries.clear()
+    session.in_book = session.book is not None
+
+
+# endregion
+
+
 def make_draft(data: dict) -> DraftChoice:
     options = DraftOptions.from_json(data)
+    session.player_id = options.PlayerId
+    session.map_size = options.MapSize
+    if session.opponent is not None:
+        session.profile = ProfileStore(PROFILES_FILE).load(session.opponent)
+    session.threats = ThreatTracker(options.MaxShipsCount, session.profile)
     choice = DraftChoice()
     choice.Ships = []
     for _ in range(options.MaxShipsCount):
         choice.Ships.append(DraftShipChoice('scout'))
+    if session.book is not None:
+        for ship, position in zip(choice.Ships, formation(options, len(choice.Ships))):
+            ship.Position = position
+    warmup(options, choice)
+    if ENSEMBLE:
+        session.ensemble = Ensemble(ENSEMBLE)
+        session.ensemble.send('draft', data)
     return choice
 
 
 def make_turn(data: dict) -> BattleOutput:
-    global target
+    ensemble = session.ensemble
+    if ensemble is None:
+        if session.pool is not None:
+            return plan_turn(session.pool.battle_state_from_json(data))
+        return plan_turn(BattleState.from_json(data))
+
+    started = time.perf_counter()
+    ensemble.send('turn', data)
+    battle_state = session.pool.battle_state_from_json(data) if session.pool is not None else \
+        BattleState.from_json(data)
+    return ensemble.choose(battle_state, plan_turn(battle_state), started + ENSEMBLE_MS / 1000)
+
+
+def plan_turn(battle_state: BattleState) -> BattleOutput:
+    started = time.perf_counter()
+    pool, threats, trace, decision_cache = session.pool, session.threats, session.trace, session.decision_cache
+
+    if pool is not None:
+        battle_output = pool.new_turn()
+        moves, pos_black_list = pool.moves, pool.pos_black_list
+    else:
+        battle_output = BattleOutput()
+        battle_output.UserCommands = []
+        # a fresh dense grid would cost the map volume every turn, the hash set only its cells
+        moves, pos_black_list = SparseCells(session.map_size), Boxes()
 
-    battle_state = BattleState.from_json(data)
-    battle_output = BattleOutput()
-    battle_output.UserCommands = []
-    moves = set()
+    threats.update(battle_state)
 
     enemies = set(battle_state.Opponent)
+    target = session.target
     if target is None or target not in battle_state.Opponent:
-        target = min(enemies,
-                     key=lambda o: (battle_state.My[0].Position.clen(o.Position), o.Health))
+        origin = battle_state.My[0].Position
+        target = min(enemies, key=lambda o: (
+            origin.clen(o.Position) // TARGET_BAND, -threats.threat(o.Id), origin.clen(o.Position), o.Health
+        ))
     else:
         # updating target position
         target = next(filter(lambda o: o == target, enemies))
-
-    pos_black_list = set()
-    for p in product(range(-ship_size, 1), repeat=3):
-        pos_black_list |= {fire.Target + Vector(*p) for fire in battle_state.FireInfos}
+    session.target = target
+    if trace.active:
+        trace.record('target', target.Id, str(target.Position))
+
+    key, anchor = None, battle_state.My[0].Position
+    if decision_cache is not None:
+        key = fingerprint(battle_state, target)
+    if session.in_book:
+        opening = None if battle_state.FireInfos else session.book.get(OpeningBook.key(battle_state), anchor)
+        if opening is not None:
+            if trace.active:
+                trace.record('book', len(opening))
+            battle_output.UserCommands.extend(opening)
+            battle_output.UserCommands.extend(allocate_fire(battle_state, target))
+            return battle_output
+        # the game has left the book and never comes back
+        session.in_book = False
+    if decision_cache is not None:
+        cached = decision_cache.get(key, anchor)
+        if cached is not None:
+            if trace.active:
+                trace.record('cache hit', len(cached))
+            battle_output.UserCommands.extend(cached)
+            return battle_output
+
+    if ENDGAME_MS > 0 and len(battle_state.My) <= ENDGAME_SHIPS and len(battle_state.Opponent) <= ENDGAME_SHIPS:
+        commands = endgame_plan(battle_state, started + ENDGAME_MS / 1000)
+        if commands is not None:
+            battle_output.UserCommands.extend(commands)
+            if decision_cache is not None:
+                decision_cache.put(key, anchor, battle_output.UserCommands)
+            return battle_output
+
+    fire_boxes(battle_state, pos_black_list)
 
     non_target = enemies - {target}
 
+    movers = []
     for ship in battle_state.My:
         engine = next(filter(lambda e: isinstance(e, EngineBlock), ship.Equipment), None)
         if engine is not None:
             step = engine.MaxAccelerate
+            reach = reach_table(step)
+            # next positions come from the current velocity plus one turn of acceleration
+            drift = ship.Position + ship.Velocity
+            movers.append((ship, sorted(
+                {v for v in map(drift.__add__, step_offsets(step))
+                 if v.in_bounds() and v not in pos_black_list and reach.can_stop(v, v - ship.Position)},
+                key=lambda v: neutral_key(drift, v)
+            )))
+
+    grid = bit_grid() if DISTANCE_FIELDS else None
+    ring, crowd = session.params['ring'], session.params['crowd']
+    fields = DistanceFields(grid, battle_state, target, list(non_target), ring,
+                            pos_black_list) if grid is not None else None
+    table = score_moves([c for _, c in movers], target.Position, [o.Position for o in non_target],
+                        [fire.Target for fire in battle_state.FireInfos], ring, crowd,
+                        lexicographic=SCORE_LEXICOGRAPHIC, fields=fields, weights=session.move_weights,
+                        origins=[ship.Position for ship, _ in movers], momentum=session.params['momentum'])
+
+    if trace.active:
+        trace.record('blacklist', len(pos_black_list))
+
+    planned = {}
+    for i, (ship, _) in enumerate(movers):
+        target_pos = planned[ship.Id] = next((v for v in table.ranking(i) if v not in moves), ship.Position)
+        moves.update(map(target_pos.__add__, step_offsets(1)))
+        if trace.active:
+            trace.record('move', ship.Id, str(target_pos), table.top(i, TRACE_TOP_K))
+
+    focus, accelerations = target, None
+    if SEARCH_MS > 0:
+        focus, accelerations = search_plan(battle_state, planned, target, started + SEARCH_MS / 1000)
+    for ship, _ in movers:
+        # the search only moves ships that can accelerate, an engine without thrust keeps its plan
+        acceleration = accelerations.get(ship.Id) if accelerations is not None else None
+        if acceleration is None:
+            battle_output.UserCommands.append(movement_command(ship, planned[ship.Id]))
+        else:
+            battle_output.UserCommands.append(accelerate_command(ship.Id, acceleration))
+
+    attacks = allocate_fire(battle_state, focus)
+    battle_output.UserCommands.extend(attacks)
+    if trace.active:
+        for attack in attacks:
+            trace.record('aim', attack.Parameters.Id, attack.Parameters.Name, str(attack.Parameters.Target))
+
+    if decision_cache is not None:
+        decision_cache.put(key, anchor, battle_output.UserCommands)
+    return battle_output
 
-            positions_set = set(filter(
-                Vector.in_bounds,
-                map(lambda v: ship.Position + Vector(*v), product((0, step, -step), repeat=3)))
-            ) - pos_black_list - moves
-
-            if positions_set:
-                target_pos = min(
-                    positions_set,
-                    key=lambda v: abs(5 - target.Position.clen(v)) + sum(map(
-                        lambda o: o.Position.clen(v) < 6, non_target
-                    ))
-                )
-            else:
-                target_pos = ship.Position
-
-            moves |= set(map(lambda v: target_pos + Vector(*v),
-                             product((0, 1, -1), repeat=3)))
 
-            battle_output.UserCommands.append(
-                UserCommand(
-                    Command='MOVE', Parameters=MoveCommandParameters(ship.Id, target_pos)
-                )
-            )
+# region batch
+
+# states decoded per bulk parse when planning a stream
+BATCH_SIZE = 256
+
+
+# Plans a sequence of states in order. With a context the states are consecutive turns of its
+# game, without one each state is planned on its own like the first turn of a fresh game.
+def make_turns(states: Iterable[dict], context: Optional[Session] = None) -> List[BattleOutput]:
+    global session
+
+    previous = session
+    session = context or Session()
+    # pooled outputs are reused by the next turn, a batch keeps all of them
+    pool, session.pool = session.pool, None
+    outputs = []
+    try:
+        states = iter(states)
+        while True:
+            chunk = list(islice(states, BATCH_SIZE))
+            if not chunk:
+                break
+            for battle_state in decode_battle_states(chunk):
+                if context is None:
+                    session.target = None
+                    session.threats = ThreatTracker(len(battle_state.Opponent))
+                outputs.append(plan_turn(battle_state))
+    finally:
+        session.pool = pool
+        session = previous
+    return outputs
+
+
+def read_states(paths: List[str]) -> Iterator[dict]:
+    for path in paths:
+        with open(path) as inp:
+            text = inp.read()
+        try:
+            yield json.loads(text)
+        except json.JSONDecodeError:
+            # JSON lines, one state per line
+            yield from (json.loads(line) for line in text.splitlines() if line.strip())
+
+
+# prints the outputs as JSON lines and the throughput to stderr
+def run_batch(paths: List[str]):
+    start_time = time.perf_counter()
+    outputs = make_turns(read_states(paths))
+    elapsed = time.perf_counter() - start_time
+    for output in outputs:
+        print(json.dumps(output, default=lambda x: x.to_json(), ensure_ascii=False))
+    rate = len(outputs) / elapsed if elapsed else float('inf')
+    sys.stderr.write(f'{len(outputs)} states in {elapsed:.3f} s: {rate:.0f} states/s\n')
 
-        for gun in filter(lambda e: isinstance(e, GunBlock), ship.Equipment):
-            aim = None
-            r = gun.Radius
 
-            if ship.Position.clen(target.Position + target.Velocity) <= r + ship_size:
-                aim = target.Position + target.Velocity
+# endregion
 
-            else:
-                opponents = [
-                    opponent for opponent in non_target
-                    if ship.Position.clen(opponent.Position + opponent.Velocity) <= r + ship_size
-                ]
-                if opponents:
-                    opponent = min(opponents, key=lambda o: o.Health)
-                    aim = opponent.Position + opponent.Velocity
-
-            if aim is not None:
-                battle_output.UserCommands.append(
-                    UserCommand(
-                        Command='ATTACK', Parameters=AttackCommandParameters(ship.Id, gun.Name, aim)
-                    )
-                )
 
-    return battle_output
+def play_draft(raw: str) -> str:
+    session.drafted = True
+    return json.dumps(make_draft(json.loads(raw)), default=lambda x: x.to_json(), ensure_ascii=False)
+
+
+def play_turn(raw: str) -> str:
+    session.trace.begin(session.moves_count)
+    start_time = time.time()
+    # the change in live blocks: what the turn keeps, not what it allocates and frees again
+    allocated = sys.getallocatedblocks()
+    if TRACE_ALLOCS:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        traced, _ = tracemalloc.get_traced_memory()
+    profiler = session.profiler
+    if profiler is not None:
+        profiler.start()
+    result_dict = make_turn(json.loads(raw))
+
+    elapsed = (time.time() - start_time) * 1000
+    if profiler is not None:
+        profiler.stop(session.moves_count, elapsed)
+    retained = sys.getallocatedblocks() - allocated
+
+    if session.max_time is None or elapsed > session.max_time:
+        session.max_time = elapsed
+        session.max_time_move = session.moves_count
+
+    result_dict.Message = (f'Max time: {session.max_time:.3f} ms; max time move: {session.max_time_move}; '
+                           f'net blocks: {retained:+d}')
+    if TRACE_ALLOCS:
+        result_dict.Message += f'; peak alloc: {tracemalloc.get_traced_memory()[1] - traced} B'
+    if session.decision_cache is not None:
+        result_dict.Message += f'; cache hits: {session.decision_cache.stats()}'
+    session.moves_count += 1
+
+    if elapsed > TRACE_SLOW_MS:
+        session.trace.dump(f'slow turn: {elapsed:.3f} ms')
+    if session.slow_turns is not None:
+        session.slow_turns.push(elapsed, session.moves_count - 1, raw)
+    return json.dumps(result_dict, default=lambda x: x.to_json(), ensure_ascii=False)
+
+
+def play_line(raw: str) -> str:
+    return play_turn(raw) if session.drafted else play_draft(raw)
+
+
+# everything the session keeps for later goes out: the trace, the captured slow turns and the
+# profiled stacks
+def flush(reason: str):
+    session.trace.dump(reason)
+    if session.slow_turns is not None:
+        session.slow_turns.write(CAPTURE_DIR)
+    if session.profiler is not None:
+        session.profiler.write(PROFILE_DIR)
+
+
+def end_game():
+    flush('game end')
+    if session.opponent is not None and session.threats.start is not None:
+        ProfileStore(PROFILES_FILE).save_async(session.opponent, session.threats.summary())
+    if session.ensemble is not None:
+        sys.stderr.write(f'ensemble picks: {session.ensemble.wins}\n')
+        session.ensemble.close()
+        session.ensemble = None
 
 
 def play_game():
-    global max_time, moves_count, max_time_move
+    print(play_draft(input()))
+    if POOLING:
+        # everything alive after the draft lives until the end of the game
+        gc.collect()
+        gc.freeze()
+        gc.disable()
 
-    print(json.dumps(make_draft(json.loads(input())),
-                     default=lambda x: x.to_json(), ensure_ascii=False))
     while True:
-        raw = input()
-        start_time = time.time()
-        result_dict = make_turn(json.loads(raw))
+        try:
+            raw = input()
+        except EOFError:
+            break
+        print(play_turn(raw))
+
+        if POOLING:
+            # collect while the other side is thinking, not in the middle of make_turn
+            gc.collect(1)
+
+    end_game()
+
 
-        elapsed = (time.time() - start_time) * 1000
+# region server
 
-        if max_time is None or elapsed > max_time:
-            max_time = elapsed
-            max_time_move = moves_count
+class Connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.session = Session()
+        # BOT_OPPONENT names the opponent of a whole process, the games of a server have no name
+        self.session.opponent = None
+        self.buffer = b''
 
-        result_dict.Message = f'Max time: {max_time:.3f} ms; max time move: {max_time_move}'
-        print(json.dumps(result_dict, default=lambda x: x.to_json(), ensure_ascii=False))
-        moves_count += 1
+
+# One warm process plays many games at once: every connection is a game speaking the usual
+# line protocol, and its Session is swapped in while its lines are handled.
+def serve(address: str):
+    global session
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = socket.create_server((host, int(port)))
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = socket.socket(socket.AF_UNIX)
+        server.bind(address)
+        server.listen()
+    server.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    default = session
+    if POOLING:
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is server:
+                sock, _ = server.accept()
+                sock.setblocking(True)
+                selector.register(sock, selectors.EVENT_READ, Connection(sock))
+                continue
+
+            connection = key.data
+            session = connection.session
+            try:
+                chunk = connection.sock.recv(1 << 16)
+                connection.buffer += chunk
+                while b'\n' in connection.buffer:
+                    line, connection.buffer = connection.buffer.split(b'\n', 1)
+                    connection.sock.sendall(play_line(line.decode()).encode() + b'\n')
+            except Exception as error:
+                # a broken line or peer ends its own game, never the others on this server
+                sys.stderr.write(f'game dropped: {error!r}\n')
+                chunk = b''
+            if not chunk:
+                selector.unregister(connection.sock)
+                connection.sock.close()
+                end_game()
+            session = default
+
+        if POOLING:
+            # all ready games are answered, collect before waiting for the next lines
+            gc.collect(1)
+
+
+# endregion
 
 
 if __name__ == '__main__':
-    player_id = 0
-    max_time, max_time_move = None, 1
-    moves_count = 1
-    play_game()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda *_: flush('signal'))
+    if len(sys.argv) == 3 and sys.argv[1] == '--serve':
+        serve(sys.argv[2])
+    elif len(sys.argv) > 2 and sys.argv[1] == '--batch':
+        run_batch(sys.argv[2:])
+    else:
+        play_game()
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+from itertools import product
+from typing import Optional, Tuple
+
+import avoiding_rays
+import merged
+from merged import BattleState, EquipmentBlock, Ship, Vector
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TESTS_DIR = os.path.join(ROOT, 'tests')
+BASELINE = os.path.join(ROOT, 'microbench_baseline.json')
+REPEATS = 5
+
+# the benchmarked states are pinned by name, captured slow turns land in the same directory and
+# must not change what a baseline was measured on
+FIXTURES = (
+    '3a9fefe3-8fb9-43ae-82a2-e739f07bd2e0.json',
+    '612bddb3-3ab3-4a17-804f-e13b9ffc2706.json',
+    'b8f6beb6-3271-4ebe-b77f-cf1a76456ce5.json',
+    'd39c364f-df78-4e02-8549-680d337c8e1a.json',
+)
+
+
+def load_fixtures() -> list:
+    fixtures = []
+    for filename in FIXTURES:
+        with open(os.path.join(TESTS_DIR, filename)) as inp:
+            fixtures.append(json.load(inp))
+    return fixtures
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as inp:
+        return json.load(inp)
+
+
+def save_baseline(path: str, results: dict):
+    baseline = {**load_baseline(path), **results}
+    with open(path, 'w') as out:
+        json.dump(baseline, out, indent=2)
+
+
+def benchmarks(fixtures: list) -> dict:
+    states = [BattleState.from_json(data) for data in fixtures]
+    raw_ships = [ship for data in fixtures for ship in data['My'] + data['Opponent']]
+    raw_equipment = [e for ship in raw_ships for e in ship.get('Equipment') or []]
+    vectors = [ship.Position for state in states for ship in state.My + state.Opponent]
+    ray_vectors = [avoiding_rays.Vector(v.X, v.Y, v.Z) for v in vectors]
+    candidates = [
+        [ship.Position + Vector(*p) for p in product((0, 1, -1), repeat=3)]
+        for ship in states[0].My
+    ]
+
+    def black_list():
+        for state in states:
+            boxes = merged.fire_boxes(state)
+            for vs in candidates:
+                [v in boxes for v in vs]
+
+    def scorer():
+        for state in states:
+            merged.score_moves(candidates, state.Opponent[0].Position,
+                               [o.Position for o in state.Opponent[1:]], [f.Target for f in state.FireInfos],
+                               origins=[ship.Position for ship in states[0].My], momentum=merged.PARAMS['momentum'])
+
+    def make_turn():
+        for data in fixtures:
+            merged.session.target = None
+            merged.make_turn(data)
+
+    outputs = []
+    for data in fixtures:
+        merged.session.target = None
+        outputs.append(merged.make_turn(data))
+
+    return {
+        'Vector.__add__': lambda: [a + b for a, b in zip(vectors, vectors[1:])],
+        'Vector.__hash__': lambda: list(map(hash, vectors)),
+        'Vector.clen': lambda: [a.clen(b) for a, b in zip(vectors, vectors[1:])],
+        'Vector.in_bounds': lambda: list(map(Vector.in_bounds, vectors)),
+        'Vector.bresenham': lambda: [a.bresenham(b) for a, b in zip(ray_vectors, ray_vectors[1:])],
+        'Ship.from_json': lambda: list(map(Ship.from_json, raw_ships)),
+        'EquipmentBlock.from_json': lambda: list(map(EquipmentBlock.from_json, raw_equipment)),
+        'BattleState.from_json': lambda: list(map(BattleState.from_json, fixtures)),
+        'pos_black_list': black_list,
+        'score_moves': scorer,
+        'JSONCapability.to_json': lambda: [
+            json.dumps(o, default=lambda x: x.to_json(), ensure_ascii=False) for o in outputs
+        ],
+        'make_turn': make_turn,
+        'make_turns': lambda: merged.make_turns(fixtures),
+    }
+
+
+# planning is measured, not cache hits; the caller installs the session and puts its own back
+def bench_session() -> merged.Session:
+    session = merged.Session()
+    session.decision_cache = None
+    return session
+
+
+# A fixed pure-Python workload. Every primitive is timed in repeats interleaved with it and the
+# baseline keeps the ratio of the two, so load on the machine and a slower or faster machine
+# cancel out and one committed baseline holds anywhere.
+def calibration():
+    table = {}
+    for i in range(2000):
+        table[i % 97] = table.get(i % 97, 0) + (i * i) % 7
+    return sorted(table.items())
+
+
+# (microseconds per call, time relative to the calibration workload)
+def measure_relative(function) -> Tuple[float, float]:
+    timers = timeit.Timer(function), timeit.Timer(calibration)
+    numbers = [timer.autorange()[0] for timer in timers]
+    best = [float('inf'), float('inf')]
+    for _ in range(REPEATS):
+        for i, timer in enumerate(timers):
+            best[i] = min(best[i], timer.timeit(numbers[i]) / numbers[i])
+    return best[0] * 1e6, best[0] / best[1]
+
+
+def change(name: str, relative: float, baseline: dict) -> Optional[float]:
+    return relative / baseline[name] - 1 if name in baseline else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the bot primitives')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('names', nargs='*', help='run only these primitives')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    merged.session = bench_session()
+    results, regressions = {}, []
+    for name, function in benchmarks(load_fixtures()).items():
+        if args.names and name not in args.names:
+            continue
+        elapsed, results[name] = measure_relative(function)
+        line = f'{name:<28} {elapsed:>12.3f} us {results[name]:>10.4f}'
+        relative = change(name, results[name], baseline)
+        if relative is not None:
+            line += f' {relative:>+8.1%}'
+            if relative > args.threshold:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f'Baseline saved to {args.baseline}')
+    elif regressions:
+        print(f'Regressed beyond {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
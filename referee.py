@@ -0,0 +1,537 @@
+import argparse
+import json
+import os
+import random
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from itertools import combinations, product
+from typing import Dict, List, Optional, Tuple
+
+MAP_SIZE = 30
+SHIP_SIZE = 2
+MAX_SHIPS = 5
+MONEY = 1000
+MAX_TURNS = 200
+DRAFT_TIMEOUT = 5.0
+ROUND_TIMEOUT = 1.0
+GAME_END_TIMEOUT = 1.0
+
+EQUIPMENT = [
+    {'Type': 0, 'IncrementPerTurn': 10, 'MaxEnergy': 100, 'StartEnergy': 50, 'Name': 'big_energy'},
+    {'Type': 3, 'MaxHealth': 100, 'StartHealth': 100, 'Name': 'big_health'},
+    {'Type': 3, 'MaxHealth': 200, 'StartHealth': 200, 'Name': 'huge_health'},
+    {'Type': 2, 'MaxAccelerate': 1, 'Name': 'big_engine'},
+    {'Type': 1, 'Damage': 20, 'EnergyPrice': 10, 'Radius': 5, 'EffectType': 0, 'Name': 'big_blaster'},
+]
+
+COMPLETE_SHIPS = [
+    {'Id': 'scout', 'Price': 200,
+     'Equipment': ['big_energy', 'big_health', 'big_engine', 'big_blaster']},
+    {'Id': 'starstorm', 'Price': 300,
+     'Equipment': ['big_energy', 'huge_health', 'big_engine', 'big_blaster', 'big_blaster']},
+]
+
+
+# region game model
+
+Coords = Tuple[int, int, int]
+
+
+def parse(data: str) -> Coords:
+    x, y, z = map(int, data.split('/'))
+    return x, y, z
+
+
+def fmt(v: Coords) -> str:
+    return f'{v[0]}/{v[1]}/{v[2]}'
+
+
+def clen(a: Coords, b: Coords) -> int:
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]), abs(a[2] - b[2]))
+
+
+def clamp(value: int, limit: int) -> int:
+    return max(-limit, min(limit, value))
+
+
+# Shots leave from the cell of the ship nearest to the target. Measured from the low corner of
+# the ship, as clen(position, target) <= Radius + SHIP_SIZE, the range reached SHIP_SIZE further
+# towards lower coordinates, and the fleet starting in the high corner outranged the other one.
+def reach(position: Coords, target: Coords) -> int:
+    return max(max(p - t, t - p - SHIP_SIZE, 0) for p, t in zip(position, target))
+
+
+@dataclass
+class RefereeShip:
+    Id: int
+    Position: Coords
+    Velocity: Coords
+    Health: int
+    Energy: int
+    Equipment: List[dict]
+    acceleration: Coords = (0, 0, 0)
+
+    def blocks(self, block_type: int) -> List[dict]:
+        return [e for e in self.Equipment if e['Type'] == block_type]
+
+    def max_accelerate(self) -> int:
+        return max((e['MaxAccelerate'] for e in self.blocks(2)), default=0)
+
+    def to_json(self, full: bool) -> dict:
+        data = {'Id': self.Id, 'Velocity': fmt(self.Velocity),
+                'Position': fmt(self.Position), 'Health': self.Health}
+        if full:
+            data['Energy'] = self.Energy
+            data['Equipment'] = self.Equipment
+        return data
+
+
+def build_ship(ship_id: int, complete_ship: dict, position: Coords) -> RefereeShip:
+    catalogue = {e['Name']: e for e in EQUIPMENT}
+    equipment = [dict(catalogue[name]) for name in complete_ship['Equipment']]
+    health = sum(e['StartHealth'] for e in equipment if e['Type'] == 3)
+    energy = sum(e['StartEnergy'] for e in equipment if e['Type'] == 0)
+    return RefereeShip(ship_id, position, (0, 0, 0), health, energy, equipment)
+
+
+def start_area(player: int, map_size: int) -> Tuple[Coords, Coords]:
+    side = map_size // 3
+    if player == 0:
+        return (0, 0, 0), (side - 1,) * 3
+    return (map_size - side,) * 3, (map_size - 1,) * 3
+
+
+def draft_options(player: int, map_size: int) -> dict:
+    lo, hi = start_area(player, map_size)
+    return {
+        'PlayerId': player,
+        'MapSize': map_size,
+        'Money': MONEY,
+        'MaxShipsCount': MAX_SHIPS,
+        'StartArea': {'From': fmt(lo), 'To': fmt(hi)},
+        'Equipment': [{'Size': 1, 'Equipment': e} for e in EQUIPMENT],
+        'CompleteShips': COMPLETE_SHIPS,
+    }
+
+
+# the high corner is the mirror image of the low one, a position p of a ship maps to
+# map_size - 1 - SHIP_SIZE - p, a cell c to map_size - 1 - c
+def mirror(v: Coords, map_size: int, size: int = SHIP_SIZE) -> Coords:
+    return tuple(map_size - 1 - size - c for c in v)
+
+
+def in_area(position: Coords, area: Tuple[Coords, Coords]) -> bool:
+    lo, hi = area
+    return all(a <= p and p + SHIP_SIZE <= b for p, a, b in zip(position, lo, hi))
+
+
+def place_ships(player: int, choice: Optional[dict], map_size: int, rng: random.Random) -> List[RefereeShip]:
+    prices = {s['Id']: s for s in COMPLETE_SHIPS}
+    area = start_area(player, map_size)
+    lo, hi = start_area(0, map_size)
+    slots = [p for p in product(*(range(a, b - SHIP_SIZE + 1, SHIP_SIZE + 1) for a, b in zip(lo, hi)))]
+    if player == 1:
+        slots = [mirror(p, map_size) for p in slots]
+    rng.shuffle(slots)
+
+    # an empty draft gets the default fleet, as on the game server
+    requests = (choice or {}).get('Ships') or [{'CompleteShipId': 'scout'}] * MAX_SHIPS
+    ships, money = [], MONEY
+    for request in requests[:MAX_SHIPS]:
+        complete_ship = prices.get(request.get('CompleteShipId'))
+        if complete_ship is None or complete_ship['Price'] > money or not slots:
+            continue
+        money -= complete_ship['Price']
+        # a drafted position outside the start area is ignored, the ship gets a drawn slot
+        try:
+            position = parse(request['Position'])
+        except (KeyError, TypeError, ValueError):
+            position = None
+        if position is None or not in_area(position, area):
+            position = slots.pop()
+        ships.append(build_ship(player * 10000 + len(ships) + 1, complete_ship, position))
+    return ships
+
+
+class Battle:
+    def __init__(self, fleets: List[List[RefereeShip]], map_size: int):
+        self.fleets = fleets
+        self.map_size = map_size
+        self.fire_infos: List[dict] = []
+        self.turn = 0
+
+    def state_for(self, player: int) -> dict:
+        return {
+            'My': [s.to_json(True) for s in self.fleets[player]],
+            'Opponent': [s.to_json(False) for s in self.fleets[1 - player]],
+            'FireInfos': self.fire_infos,
+        }
+
+    def apply(self, commands: List[Optional[dict]]):
+        shots = []
+        for player, output in enumerate(commands):
+            own = {s.Id: s for s in self.fleets[player]}
+            for command in ((output or {}).get('UserCommands') or []):
+                try:
+                    ship = own.get(command['Parameters']['Id'])
+                    if ship is not None:
+                        self.command(ship, command['Command'], command['Parameters'], shots)
+                except (KeyError, TypeError, ValueError):
+                    continue
+
+        limit = self.map_size - 1 - SHIP_SIZE
+        for ship in (s for fleet in self.fleets for s in fleet):
+            velocity = tuple(v + a for v, a in zip(ship.Velocity, ship.acceleration))
+            position = tuple(p + v for p, v in zip(ship.Position, velocity))
+            ship.Velocity = tuple(v if 0 <= p <= limit else 0 for p, v in zip(position, velocity))
+            ship.Position = tuple(max(0, min(limit, p)) for p in position)
+            ship.acceleration = (0, 0, 0)
+
+        for _, target, damage in shots:
+            for ship in (s for fleet in self.fleets for s in fleet):
+                if all(0 <= t - p <= SHIP_SIZE for t, p in zip(target, ship.Position)):
+                    ship.Health -= damage
+
+        for fleet in self.fleets:
+            fleet[:] = [s for s in fleet if s.Health > 0]
+            for ship in fleet:
+                for block in ship.blocks(0):
+                    ship.Energy = min(block['MaxEnergy'], ship.Energy + block['IncrementPerTurn'])
+
+        self.fire_infos = [{'Source': fmt(s), 'Target': fmt(t), 'EffectType': 0} for s, t, _ in shots]
+        self.turn += 1
+
+    @staticmethod
+    def command(ship: RefereeShip, name: str, parameters: dict, shots: list):
+        if name == 'MOVE':
+            limit = ship.max_accelerate()
+            target = parse(parameters['Target'])
+            ship.acceleration = tuple(
+                clamp(t - p - v, limit) for t, p, v in zip(target, ship.Position, ship.Velocity)
+            )
+        elif name == 'ACCELERATE':
+            limit = ship.max_accelerate()
+            ship.acceleration = tuple(clamp(a, limit) for a in parse(parameters['Vector']))
+        elif name == 'ATTACK':
+            gun = next((g for g in ship.blocks(1) if g['Name'] == parameters['Name']), None)
+            target = parse(parameters['Target'])
+            if gun is None or ship.Energy < gun['EnergyPrice']:
+                return
+            if reach(ship.Position, target) > gun['Radius']:
+                return
+            ship.Energy -= gun['EnergyPrice']
+            shots.append((ship.Position, target, gun['Damage']))
+
+    def finished(self) -> bool:
+        return not all(self.fleets) or self.turn >= MAX_TURNS
+
+    def winner(self) -> Optional[int]:
+        totals = [sum(s.Health for s in fleet) for fleet in self.fleets]
+        if totals[0] == totals[1]:
+            return None
+        return 0 if totals[0] > totals[1] else 1
+
+
+# endregion
+
+# region bot processes
+
+# a bot is a script run as a subprocess, or 'unix:PATH' / 'tcp:HOST:PORT' of a bot server
+# where every connection is a separate game
+class BotProcess:
+    def __init__(self, path: str, opponent: Optional[str] = None):
+        self.path = path
+        self.process = self.sock = None
+        if path.startswith(('unix:', 'tcp:')):
+            kind, address = path.split(':', 1)
+            if kind == 'unix':
+                self.sock = socket.socket(socket.AF_UNIX)
+                self.sock.connect(address)
+            else:
+                host, port = address.rsplit(':', 1)
+                self.sock = socket.create_connection((host, int(port)))
+            self.reader = self.sock.fileno()
+            self.write = self.sock.sendall
+        else:
+            # the protocol never names the opponent, bots that keep profiles learn it from here
+            env = {k: v for k, v in os.environ.items() if k != 'BOT_OPPONENT'}
+            if opponent:
+                env['BOT_OPPONENT'] = opponent
+            self.process = subprocess.Popen(
+                [sys.executable, '-u', path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, bufsize=0, cwd=os.path.dirname(os.path.abspath(path)), env=env,
+            )
+            self.reader = self.process.stdout.fileno()
+            self.write = self.process.stdin.write
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.reader, selectors.EVENT_READ)
+        self.buffer = b''
+        self.alive = True
+        self.timeouts = 0
+        self.latencies: List[float] = []
+
+    def ask(self, data: dict, timeout: float) -> Optional[dict]:
+        if not self.alive:
+            return None
+        start = time.perf_counter()
+        try:
+            self.write(json.dumps(data).encode() + b'\n')
+        except (BrokenPipeError, OSError):
+            self.close()
+            return None
+
+        deadline = start + timeout
+        while b'\n' not in self.buffer:
+            left = deadline - time.perf_counter()
+            if left <= 0 or not self.selector.select(left):
+                # a late answer would be read as the reply to the next state, so the bot is out
+                self.timeouts += 1
+                self.close()
+                return None
+            chunk = os.read(self.reader, 1 << 16)
+            if not chunk:
+                self.close()
+                return None
+            self.buffer += chunk
+
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        self.latencies.append((time.perf_counter() - start) * 1000)
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def close(self):
+        if self.alive:
+            self.alive = False
+            self.selector.close()
+            if self.sock is not None:
+                self.sock.close()
+            else:
+                # EOF ends the game, the bot gets a moment for its game-end dumps
+                try:
+                    self.process.stdin.close()
+                    self.process.wait(GAME_END_TIMEOUT)
+                except (OSError, subprocess.TimeoutExpired):
+                    self.process.kill()
+                    self.process.wait()
+
+
+# with profiles, every bot learns its opponent's name and may keep what it learns across matches;
+# off by default, so that a run does not depend on the ones before it
+def run_match(bots: Tuple[str, str], seed: int, map_size: int = MAP_SIZE,
+              round_timeout: float = ROUND_TIMEOUT, log: bool = False, profiles: bool = False) -> dict:
+    rng = random.Random(seed)
+    processes = [BotProcess(path, os.path.basename(other) if profiles else None)
+                 for path, other in zip(bots, bots[::-1])]
+    try:
+        choices = [p.ask(draft_options(i, map_size), DRAFT_TIMEOUT) for i, p in enumerate(processes)]
+        for p in processes:
+            p.latencies.clear()
+        battle = Battle([place_ships(i, c, map_size, rng) for i, c in enumerate(choices)], map_size)
+
+        while not battle.finished():
+            outputs = [p.ask(battle.state_for(i), round_timeout) for i, p in enumerate(processes)]
+            if log:
+                messages = [(o or {}).get('Message') for o in outputs]
+                print(f'turn {battle.turn}: {[len(f) for f in battle.fleets]} {messages}', file=sys.stderr)
+            battle.apply(outputs)
+            if not any(p.alive for p in processes):
+                break
+    finally:
+        for p in processes:
+            p.close()
+
+    return {
+        'bots': list(bots),
+        'seed': seed,
+        'winner': battle.winner(),
+        'turns': battle.turn,
+        'health': [sum(s.Health for s in fleet) for fleet in battle.fleets],
+        'latencies': [p.latencies for p in processes],
+        'timeouts': [p.timeouts for p in processes],
+    }
+
+
+# endregion
+
+# region tournament
+
+@dataclass
+class BotStats:
+    matches: int = 0
+    wins: int = 0
+    draws: int = 0
+    timeouts: int = 0
+    latencies: List[float] = field(default_factory=list)
+    # matches and wins per start corner, player 0 starts low and player 1 high
+    corner_matches: List[int] = field(default_factory=lambda: [0, 0])
+    corner_wins: List[int] = field(default_factory=lambda: [0, 0])
+
+    def row(self, name: str) -> str:
+        lat = sorted(self.latencies) or [0.0]
+        p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+        low, high = (w / max(1, m) for w, m in zip(self.corner_wins, self.corner_matches))
+        return (f'{name:<36} {self.matches:>7} {self.wins / max(1, self.matches):>8.1%} {low:>7.1%} {high:>7.1%} '
+                f'{self.draws:>6} {statistics.fmean(lat):>9.3f} {p95:>9.3f} {lat[-1]:>9.3f} {self.timeouts:>8}')
+
+
+def tournament(bots: List[str], matches: int, workers: int, map_size: int,
+               round_timeout: float, seed: int, profiles: bool = False) -> Dict[str, BotStats]:
+    stats = {bot: BotStats() for bot in bots}
+    jobs = []
+    for a, b in combinations(bots, 2):
+        for i in range(matches):
+            jobs.append(((a, b) if i % 2 == 0 else (b, a), seed + len(jobs)))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_match, pair, s, map_size, round_timeout, False, profiles) for pair, s in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            for side, bot in enumerate(result['bots']):
+                stat = stats[bot]
+                stat.matches += 1
+                stat.wins += result['winner'] == side
+                stat.corner_matches[side] += 1
+                stat.corner_wins[side] += result['winner'] == side
+                stat.draws += result['winner'] is None
+                stat.timeouts += result['timeouts'][side]
+                stat.latencies += result['latencies'][side]
+            if done % 100 == 0:
+                print(f'{done}/{len(jobs)} matches, {done / (time.perf_counter() - start):.1f} matches/s',
+                      file=sys.stderr)
+    return stats
+
+
+# endregion
+
+# region mirror check
+
+def mirror_command(command: dict, map_size: int) -> dict:
+    parameters = dict(command['Parameters'])
+    if command['Command'] == 'ACCELERATE':
+        parameters['Vector'] = fmt(tuple(-a for a in parse(parameters['Vector'])))
+    elif command['Command'] == 'MOVE':
+        parameters['Target'] = fmt(mirror(parse(parameters['Target']), map_size))
+    elif command['Command'] == 'ATTACK':
+        parameters['Target'] = fmt(mirror(parse(parameters['Target']), map_size, 0))
+    return {'Command': command['Command'], 'Parameters': parameters}
+
+
+def random_commands(fleet: List[RefereeShip], opponents: List[RefereeShip], map_size: int,
+                    rng: random.Random) -> dict:
+    commands = []
+    for ship in fleet:
+        if rng.random() < 0.5:
+            vector = tuple(rng.randint(-1, 1) for _ in range(3))
+            commands.append({'Command': 'ACCELERATE', 'Parameters': {'Id': ship.Id, 'Vector': fmt(vector)}})
+        else:
+            target = tuple(rng.randrange(map_size - SHIP_SIZE) for _ in range(3))
+            commands.append({'Command': 'MOVE', 'Parameters': {'Id': ship.Id, 'Target': fmt(target)}})
+        if opponents:
+            aim = rng.choice(opponents).Position
+            target = tuple(c + rng.randint(-1, SHIP_SIZE + 1) for c in aim)
+            commands.append({'Command': 'ATTACK',
+                             'Parameters': {'Id': ship.Id, 'Name': 'big_blaster', 'Target': fmt(target)}})
+    return {'UserCommands': commands}
+
+
+# The rules have no preferred direction when a battle and its mirror image, played with mirrored
+# commands, stay mirror images of each other turn after turn. Commands are random, aimed near
+# the opponents so that shots land and ships die.
+def check_mirror(seed: int, map_size: int = MAP_SIZE) -> bool:
+    rng = random.Random(seed)
+    fleets = [place_ships(i, None, map_size, rng) for i in range(2)]
+    images = [[RefereeShip(s.Id, mirror(s.Position, map_size), s.Velocity, s.Health, s.Energy,
+                           [dict(e) for e in s.Equipment]) for s in fleet] for fleet in fleets]
+    battle, image = Battle(fleets, map_size), Battle(images, map_size)
+
+    while not battle.finished():
+        commands = [random_commands(battle.fleets[i], battle.fleets[1 - i], map_size, rng) for i in range(2)]
+        battle.apply(commands)
+        image.apply([{'UserCommands': [mirror_command(c, map_size) for c in o['UserCommands']]}
+                     for o in commands])
+        expected = [[(s.Id, mirror(s.Position, map_size), tuple(-v for v in s.Velocity), s.Health, s.Energy)
+                     for s in fleet] for fleet in battle.fleets]
+        if expected != [[(s.Id, s.Position, s.Velocity, s.Health, s.Energy) for s in fleet]
+                        for fleet in image.fleets]:
+            return False
+    return True
+
+
+# a bot against itself: whatever one corner wins more comes from the bot, the rules are checked
+def mirror_matches(bot: str, matches: int, workers: int, map_size: int, round_timeout: float,
+                   seed: int) -> List[int]:
+    wins = [0, 0, 0]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_match, (bot, bot), seed + i, map_size, round_timeout) for i in range(matches)]
+        for future in as_completed(futures):
+            winner = future.result()['winner']
+            wins[2 if winner is None else winner] += 1
+    return wins
+
+
+# endregion
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local referee for the battle bots')
+    parser.add_argument('--map-size', type=int, default=MAP_SIZE)
+    parser.add_argument('--round-timeout', type=float, default=ROUND_TIMEOUT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profiles', action='store_true',
+                        help='tell the bots their opponent (BOT_OPPONENT) so they keep profiles across matches')
+    commands = parser.add_subparsers(dest='mode', required=True)
+
+    match = commands.add_parser('match', help='play a single logged match')
+    match.add_argument('bots', nargs=2)
+
+    tour = commands.add_parser('tournament', help='round-robin over a process pool')
+    tour.add_argument('bots', nargs='+')
+    tour.add_argument('--matches', type=int, default=100, help='matches per pair')
+    tour.add_argument('--workers', type=int, default=os.cpu_count())
+
+    check = commands.add_parser('mirror', help='check that neither start corner is favoured')
+    check.add_argument('bots', nargs='*', help='bots to play against themselves')
+    check.add_argument('--matches', type=int, default=20, help='rule checks and matches per bot')
+    check.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.mode == 'mirror':
+        broken = [s for s in range(args.seed, args.seed + args.matches) if not check_mirror(s, args.map_size)]
+        print(f'rules: {args.matches - len(broken)}/{args.matches} battles mirror exactly'
+              + (f', broken seeds {broken}' if broken else ''))
+        for bot in args.bots:
+            low, high, draws = mirror_matches(bot, args.matches, args.workers, args.map_size, args.round_timeout,
+                                              args.seed)
+            print(f'{bot}: low corner {low}, high corner {high}, draws {draws}')
+        sys.exit(1 if broken else 0)
+
+    if args.mode == 'match':
+        result = run_match(tuple(args.bots), args.seed, args.map_size, args.round_timeout, log=True,
+                           profiles=args.profiles)
+        result['latencies'] = [
+            {'mean': statistics.fmean(lat), 'max': max(lat)} if lat else None for lat in result['latencies']
+        ]
+        print(json.dumps(result, indent=2))
+        return
+
+    start = time.perf_counter()
+    stats = tournament(args.bots, args.matches, args.workers, args.map_size, args.round_timeout, args.seed,
+                       args.profiles)
+    print(f'{"bot":<36} {"matches":>7} {"win rate":>8} {"low":>7} {"high":>7} {"draws":>6} {"mean ms":>9} '
+          f'{"p95 ms":>9} {"max ms":>9} {"timeouts":>8}')
+    for bot, stat in sorted(stats.items(), key=lambda kv: -kv[1].wins / max(1, kv[1].matches)):
+        print(stat.row(bot))
+    print(f'Total time: {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
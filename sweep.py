@@ -0,0 +1,147 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from typing import Dict, List
+
+from fit_moves import self_play
+from merged import PARAMS
+
+CACHE = 'sweep_cache.jsonl'
+
+# sampling ranges of the random and successive-halving modes
+RANGES = {
+    'ring': (2, 9),
+    'crowd': (2, 10),
+    'ship_size': (1, 3),
+    'gun_slack': (0, 4),
+    'momentum': (0, 4),
+}
+
+
+def params_key(params: dict) -> str:
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# One duel of the candidate against the default parameters. Seeds alternate the seats, so the
+# side advantage cancels out over a corpus.
+def evaluate(params: dict, seed: int) -> dict:
+    seat = seed % 2
+    pair = (params, None) if seat == 0 else (None, params)
+    result = self_play(seed, params=pair, record=False)
+    health = result['health']
+    return {
+        'key': params_key(params), 'params': params, 'seed': seed,
+        'score': 0.5 if result['winner'] is None else float(result['winner'] == seat),
+        'margin': health[seat] - health[1 - seat],
+    }
+
+
+class Cache:
+    def __init__(self, path: str):
+        self.path = path
+        self.results = {}
+        if os.path.exists(path):
+            with open(path) as inp:
+                for line in inp:
+                    if line.strip():
+                        result = json.loads(line)
+                        self.results[(result['key'], result['seed'])] = result
+
+    def get(self, params: dict, seed: int):
+        return self.results.get((params_key(params), seed))
+
+    def put(self, result: dict):
+        self.results[(result['key'], result['seed'])] = result
+        # appended as soon as a duel finishes, so an interrupted sweep resumes from here
+        with open(self.path, 'a') as out:
+            out.write(json.dumps(result) + '\n')
+
+
+def run(candidates: List[dict], seeds: List[int], cache: Cache, workers: int) -> Dict[str, dict]:
+    jobs = [(p, s) for p in candidates for s in seeds if cache.get(p, s) is None]
+    start = time.perf_counter()
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(evaluate, p, s) for p, s in jobs]
+            for done, future in enumerate(as_completed(futures), 1):
+                cache.put(future.result())
+                if done % 50 == 0:
+                    print(f'{done}/{len(jobs)} duels, {done / (time.perf_counter() - start):.1f} duels/s',
+                          file=sys.stderr)
+
+    summary = {}
+    for p in candidates:
+        results = [cache.get(p, s) for s in seeds]
+        summary[params_key(p)] = {
+            'params': p,
+            'score': sum(r['score'] for r in results) / len(results),
+            'margin': sum(r['margin'] for r in results) / len(results),
+        }
+    return summary
+
+
+def grid(axes: Dict[str, List[int]]) -> List[dict]:
+    names = list(axes)
+    return [{**PARAMS, **dict(zip(names, values))} for values in product(*(axes[n] for n in names))]
+
+
+def sample(rng: random.Random, count: int) -> List[dict]:
+    return [{**PARAMS, **{name: rng.randint(*RANGES[name]) for name in RANGES}} for _ in range(count)]
+
+
+# every round keeps the best 1 / eta of the candidates and plays eta times more seeds
+def successive_halving(candidates: List[dict], seeds: int, eta: int, seed: int, cache: Cache,
+                       workers: int) -> Dict[str, dict]:
+    summary = {}
+    while True:
+        summary = run(candidates, list(range(seed, seed + seeds)), cache, workers)
+        if len(candidates) <= 1:
+            return summary
+        ranked = sorted(summary.values(), key=lambda s: (-s['score'], -s['margin']))
+        candidates = [s['params'] for s in ranked[:max(1, len(candidates) // eta)]]
+        seeds *= eta
+
+
+def parse_axis(text: str) -> tuple:
+    name, values = text.split('=', 1)
+    if name not in PARAMS:
+        raise argparse.ArgumentTypeError(f'unknown parameter {name}, expected one of {", ".join(PARAMS)}')
+    return name, [int(v) for v in values.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep the strategy constants of merged.py')
+    parser.add_argument('axes', nargs='*', type=parse_axis, help='grid axes such as ring=4,5,6')
+    parser.add_argument('--random', type=int, default=0, help='sample this many parameter sets instead')
+    parser.add_argument('--halving', action='store_true', help='successive halving over the samples')
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--seeds', type=int, default=20, help='duels per parameter set (first round)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--cache', default=CACHE)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    cache = Cache(args.cache)
+    candidates = sample(random.Random(args.seed), args.random) if args.random else grid(dict(args.axes))
+    start = time.perf_counter()
+    if args.halving:
+        summary = successive_halving(candidates, args.seeds, args.eta, args.seed, cache, args.workers)
+    else:
+        summary = run(candidates, list(range(args.seed, args.seed + args.seeds)), cache, args.workers)
+
+    print(f'{"score":>6} {"margin":>8}  parameters')
+    for s in sorted(summary.values(), key=lambda s: (-s['score'], -s['margin']))[:args.top]:
+        changed = {k: v for k, v in s['params'].items() if PARAMS[k] != v}
+        print(f'{s["score"]:>6.1%} {s["margin"]:>8.1f}  {json.dumps(changed) if changed else "defaults"}')
+    print(f'Total time: {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
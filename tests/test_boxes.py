@@ -0,0 +1,125 @@
+import os
+import random
+import sys
+from itertools import product
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from merged import BitGrid, Boxes, Vector  # noqa: E402
+
+SIZE = 8
+CELLS = [Vector(*p) for p in product(range(-2, SIZE + 2), repeat=3)]
+
+
+def random_boxes(rng: random.Random) -> list:
+    return [(Vector(*(rng.randint(-3, SIZE) for _ in range(3))), rng.randint(0, 3)) for _ in range(rng.randint(0, 12))]
+
+
+def in_box(v: Vector, low: Vector, extent: int) -> bool:
+    return all(lo <= c <= lo + extent for c, lo in zip((v.X, v.Y, v.Z), (low.X, low.Y, low.Z)))
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_boxes_contain_the_cells_of_their_boxes(seed):
+    rng = random.Random(seed)
+    raw = random_boxes(rng)
+    boxes = Boxes()
+    for low, extent in raw:
+        boxes.add(low, extent)
+    for v in CELLS:
+        assert (v in boxes) == any(in_box(v, low, extent) for low, extent in raw), v
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_mask_covers_the_same_cells(seed):
+    rng = random.Random(seed)
+    raw = random_boxes(rng)
+    boxes, grid = Boxes(), BitGrid(SIZE)
+    for low, extent in raw:
+        boxes.add(low, extent)
+    mask = boxes.mask(grid)
+    for v in CELLS:
+        i = grid.index(v)
+        if i is not None:
+            assert bool(mask >> i & 1) == (v in boxes), v
+
+
+# level by level over the cells: within step of the previous level and not blocked
+def brute_distances(sources: set, blocked: set, step: int) -> dict:
+    inside = [Vector(*p) for p in product(range(SIZE), repeat=3)]
+    level = {v for v in sources if v not in blocked}
+    distances = dict.fromkeys(level, 0)
+    k = 0
+    while level:
+        k += 1
+        level = {v for v in inside if v not in blocked and v not in distances and
+                 any(v.clen(u) <= step for u in level)}
+        distances.update(dict.fromkeys(level, k))
+    return distances
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_field_distances_match_a_plain_search(seed):
+    rng = random.Random(seed)
+    grid = BitGrid(SIZE)
+    inside = [Vector(*p) for p in product(range(SIZE), repeat=3)]
+    sources = set(rng.sample(inside, rng.randint(1, 3)))
+    blocked = set(rng.sample(inside, rng.randint(0, 150))) - sources
+    step = rng.choice((1, 2))
+    field = grid.field(grid.cells(sources), grid.cells(blocked), step)
+    expected = brute_distances(sources, blocked, step)
+    for v in inside:
+        assert field.distance(v) == expected.get(v), v
+
+
+REACH_SIZE = 12
+
+
+# turn by turn over (position, velocity) states like the referee moves ships: a coordinate past
+# a wall stops there with no velocity on that axis, a state in a blocked cell is dropped
+def brute_turns(start: Vector, velocity: Vector, blocked: set, step: int, limit: int) -> dict:
+    accelerations = list(product(range(-step, step + 1), repeat=3))
+    states = {((start.X, start.Y, start.Z), (velocity.X, velocity.Y, velocity.Z))}
+    turns = {start: 0}
+    for k in range(1, limit + 1):
+        following = set()
+        for p, v in states:
+            for a in accelerations:
+                moved = [(c + u + d, u + d) for c, u, d in zip(p, v, a)]
+                moved = [(min(max(c, 0), REACH_SIZE - 1), u if 0 <= c < REACH_SIZE else 0) for c, u in moved]
+                if Vector(*(c for c, _ in moved)) not in blocked:
+                    following.add((tuple(c for c, _ in moved), tuple(u for _, u in moved)))
+        states = following
+        for p, _ in states:
+            turns.setdefault(Vector(*p), k)
+    return turns
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_reach_is_a_lower_bound_of_the_turns(seed):
+    rng = random.Random(seed)
+    grid = BitGrid(REACH_SIZE)
+    inside = [Vector(*p) for p in product(range(REACH_SIZE), repeat=3)]
+    velocity = Vector(*(rng.randint(-3, 3) for _ in range(3)))
+    start = Vector(*(rng.randint(0, REACH_SIZE - 1) for _ in range(3)))
+    blocked = set(rng.sample(inside, rng.randint(0, 600))) - {start}
+    field = grid.reach(start, velocity, grid.cells(blocked), 1, 3)
+    expected = brute_turns(start, velocity, blocked, 1, 3)
+    for v in inside:
+        if v in expected:
+            assert field.distance(v) is not None and field.distance(v) <= expected[v], v
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_reach_is_exact_on_open_space(seed):
+    rng = random.Random(seed)
+    grid = BitGrid(REACH_SIZE)
+    # two turns at step 1 and speed 1 stay within 5 cells of the start, clear of the walls
+    velocity = Vector(*(rng.randint(-1, 1) for _ in range(3)))
+    start = Vector(*(rng.randint(5, REACH_SIZE - 6) for _ in range(3)))
+    field = grid.reach(start, velocity, 0, 1, 2)
+    expected = brute_turns(start, velocity, set(), 1, 2)
+    for v in (Vector(*p) for p in product(range(REACH_SIZE), repeat=3)):
+        assert field.distance(v) == expected.get(v), v
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import merged  # noqa: E402
+import microbench  # noqa: E402
+
+# looser than the command line default, the suite also runs on loaded machines
+THRESHOLD = float(os.environ.get('MICROBENCH_THRESHOLD', 0.5))
+# MICROBENCH_SAVE=1 stores the measurements as the new baseline instead of comparing
+SAVE = os.environ.get('MICROBENCH_SAVE') == '1'
+BASELINE = os.environ.get('MICROBENCH_BASELINE', microbench.BASELINE)
+
+NAMES = (
+    'Vector.__add__', 'Vector.__hash__', 'Vector.clen', 'Vector.in_bounds', 'Vector.bresenham',
+    'Ship.from_json', 'EquipmentBlock.from_json', 'BattleState.from_json', 'pos_black_list',
+    'score_moves', 'JSONCapability.to_json', 'make_turn', 'make_turns',
+)
+
+
+# the benchmarks play turns, they get a session of their own and the module's is put back after
+@pytest.fixture(scope='module')
+def bench():
+    previous, merged.session = merged.session, microbench.bench_session()
+    try:
+        benchmarks = microbench.benchmarks(microbench.load_fixtures())
+        assert tuple(benchmarks) == NAMES
+        yield benchmarks
+    finally:
+        merged.session = previous
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_primitive(bench, name):
+    elapsed, relative = microbench.measure_relative(bench[name])
+    if SAVE:
+        microbench.save_baseline(BASELINE, {name: relative})
+        return
+    change = microbench.change(name, relative, microbench.load_baseline(BASELINE))
+    assert change is not None, f'no baseline for {name} in {BASELINE}, run with MICROBENCH_SAVE=1'
+    assert change <= THRESHOLD, f'{name}: {elapsed:.3f} us, {change:+.1%} against the baseline'